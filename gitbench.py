@@ -0,0 +1,432 @@
+import os, sys, json, zlib, time, random, shutil, hashlib, argparse, tempfile, subprocess, tracemalloc, platform
+from struct import pack
+from gittool import GitRepo, GitObjectType
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def objectid(ftype, raw):
+    return hashlib.sha1(b"%s %d\x00" % (ftype.name.encode(), len(raw)) + raw).digest()
+
+
+def encodesize(n):
+    ret = bytearray()
+    while True:
+        c = n & 127
+        n >>= 7
+        if n:
+            ret.append(c | 128)
+        else:
+            ret.append(c)
+            return bytes(ret)
+
+
+def encodeheader(ftype, n):
+    c = (ftype << 4) | (n & 15)
+    n >>= 4
+    ret = bytearray()
+    while n:
+        ret.append(c | 128)
+        c = n & 127
+        n >>= 7
+    ret.append(c)
+    return bytes(ret)
+
+
+def encodeofs(ofs):
+    ret = bytearray([ofs & 127])
+    ofs >>= 7
+    while ofs:
+        ofs -= 1
+        ret.insert(0, 128 | (ofs & 127))
+        ofs >>= 7
+    return bytes(ret)
+
+
+def makedelta(base, target):
+    prefix = 0
+    limit = min(len(base), len(target))
+    while prefix < limit and base[prefix] == target[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and base[-1 - suffix] == target[-1 - suffix]:
+        suffix += 1
+    ops = [encodesize(len(base)), encodesize(len(target))]
+
+    def copy(off, size):
+        while size > 0:
+            chunk = min(size, 0xFFFFFF)
+            cmd = 128
+            args = bytearray()
+            for i in range(4):
+                if off >> (8 * i) & 255:
+                    cmd |= 1 << i
+                    args.append(off >> (8 * i) & 255)
+            for i in range(3):
+                if chunk >> (8 * i) & 255:
+                    cmd |= 16 << i
+                    args.append(chunk >> (8 * i) & 255)
+            ops.append(bytes([cmd]) + bytes(args))
+            off += chunk
+            size -= chunk
+
+    def insert(data):
+        for i in range(0, len(data), 127):
+            ops.append(bytes([len(data[i:i + 127])]) + data[i:i + 127])
+
+    copy(0, prefix)
+    insert(target[prefix:len(target) - suffix])
+    copy(len(base) - suffix, suffix)
+    return b''.join(ops)
+
+
+class SyntheticRepo:
+    def __init__(self, path, commits=500, width=8, depth=3, fanout=2, changes=3, deltadepth=10, layout="pack", blobsize=4096, seed=1):
+        self.path = path
+        self.commits = commits
+        self.width = width
+        self.depth = depth
+        self.fanout = fanout
+        self.changes = changes
+        self.deltadepth = deltadepth
+        self.layout = layout
+        self.blobsize = blobsize
+        self.random = random.Random(seed)
+        self.objects = []
+        self.known = set()
+        self.blobbase = {}
+
+    def randomline(self):
+        return ("%08x %s\n" % (self.random.getrandbits(32), "x" * self.random.randint(10, 70))).encode()
+
+    def randomblob(self):
+        lines = []
+        size = 0
+        while size < self.blobsize:
+            lines.append(self.randomline())
+            size += len(lines[-1])
+        return b''.join(lines)
+
+    def listpaths(self, prefix="", level=0):
+        paths = [prefix + "file%d.txt" % i for i in range(self.width)]
+        if level < self.depth:
+            for i in range(self.fanout):
+                paths += self.listpaths(prefix + "dir%d/" % i, level + 1)
+        return paths
+
+    def addobj(self, ftype, raw, base=None):
+        objid = objectid(ftype, raw)
+        if objid not in self.known:
+            self.known.add(objid)
+            self.objects.append((objid, ftype, raw, base))
+        return objid
+
+    def writetree(self, files, prefix=""):
+        entries = {}
+        for path, blobid in files.items():
+            if not path.startswith(prefix):
+                continue
+            name = path[len(prefix):]
+            if "/" in name:
+                entries[name.split("/")[0]] = None
+            else:
+                entries[name] = blobid
+        raw = []
+        for name in sorted(entries, key=lambda n: n + "/" if entries[n] == None else n):
+            if entries[name] == None:
+                raw.append(b"40000 " + name.encode() + b"\x00" + self.writetree(files, prefix + name + "/"))
+            else:
+                raw.append(b"100644 " + name.encode() + b"\x00" + entries[name])
+        return self.addobj(GitObjectType.tree, b''.join(raw))
+
+    def generate(self):
+        paths = self.listpaths()
+        contents = {p: self.randomblob() for p in paths}
+        files = {p: self.addobj(GitObjectType.blob, contents[p]) for p in paths}
+        parent = None
+        when = 1500000000
+        authors = ["Alice Dev", "Bob Builder", "Carol Coder", "Dan Debug"]
+        for n in range(self.commits):
+            if n:
+                for path in self.random.sample(paths, min(self.changes, len(paths))):
+                    old = contents[path]
+                    pos = self.random.randrange(0, len(old) + 1)
+                    pos = old.rfind(b"\n", 0, pos) + 1
+                    contents[path] = old[:pos] + self.randomline() + old[pos:]
+                    files[path] = self.addobj(GitObjectType.blob, contents[path], files[path])
+            tree = self.writetree(files)
+            author = self.random.choice(authors)
+            when += self.random.randint(60, 86400)
+            raw = "tree %s\n" % tree.hex()
+            if parent:
+                raw += "parent %s\n" % parent.hex()
+            raw += "author %s <dev@example.com> %d +0000\n" % (author, when)
+            raw += "committer %s <dev@example.com> %d +0000\n" % (author, when)
+            raw += "\ncommit %d\n" % n
+            parent = self.addobj(GitObjectType.commit, raw.encode())
+        self.head = parent
+        self.paths = paths
+        self.write()
+        return self
+
+    def write(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        for sub in ("objects/pack", "objects/info", "refs/heads", "refs/tags"):
+            os.makedirs(os.path.join(self.path, sub))
+        open(os.path.join(self.path, "HEAD"), "w").write("ref: refs/heads/main\n")
+        open(os.path.join(self.path, "config"), "w").write("[core]\n\trepositoryformatversion = 0\n\tbare = true\n")
+        open(os.path.join(self.path, "packed-refs"), "w").write("# pack-refs with: peeled fully-peeled sorted \n")
+        open(os.path.join(self.path, "refs", "heads", "main"), "w").write(self.head.hex() + "\n")
+        if self.layout == "loose":
+            self.writeloose()
+        else:
+            self.writepack()
+
+    def writeloose(self):
+        for objid, ftype, raw, base in self.objects:
+            hexstr = objid.hex()
+            folder = os.path.join(self.path, "objects", hexstr[0:2])
+            os.makedirs(folder, exist_ok=True)
+            data = b"%s %d\x00" % (ftype.name.encode(), len(raw)) + raw
+            open(os.path.join(folder, hexstr[2:]), "wb").write(zlib.compress(data))
+
+    def writepack(self):
+        out = [b"PACK" + pack(">II", 2, len(self.objects))]
+        pos = len(out[0])
+        entries = []
+        offsets = {}
+        chains = {}
+        raws = {}
+        for objid, ftype, raw, base in self.objects:
+            if base in offsets and chains[base] < self.deltadepth:
+                delta = makedelta(raws[base], raw)
+                data = encodeheader(GitObjectType.ofs_delta, len(delta)) + encodeofs(pos - offsets[base]) + zlib.compress(delta)
+                chains[objid] = chains[base] + 1
+            else:
+                data = encodeheader(ftype, len(raw)) + zlib.compress(raw)
+                chains[objid] = 0
+            if ftype == GitObjectType.blob:
+                raws[objid] = raw
+            offsets[objid] = pos
+            entries.append((objid, zlib.crc32(data), pos))
+            out.append(data)
+            pos += len(data)
+        body = b''.join(out)
+        packsum = hashlib.sha1(body).digest()
+        name = os.path.join(self.path, "objects", "pack", "pack-" + packsum.hex())
+        open(name + ".pack", "wb").write(body + packsum)
+
+        entries.sort()
+        fanout = [0] * 256
+        for objid, crc, off in entries:
+            fanout[objid[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        idx = [b"\xfftOc" + pack(">I", 2), pack(">256I", *fanout)]
+        idx += [objid for objid, crc, off in entries]
+        idx.append(pack(">%dI" % len(entries), *[crc for objid, crc, off in entries]))
+        large = []
+        for objid, crc, off in entries:
+            if off >= 0x80000000:
+                idx.append(pack(">I", 0x80000000 | len(large)))
+                large.append(off)
+            else:
+                idx.append(pack(">I", off))
+        idx.append(pack(">%dQ" % len(large), *large))
+        idx.append(packsum)
+        idx = b''.join(idx)
+        open(name + ".idx", "wb").write(idx + hashlib.sha1(idx).digest())
+
+
+class Benchmark:
+    def __init__(self, gitdir, repeat=3, samples=2000, seed=1, branch=None):
+        self.gitdir = gitdir
+        self.repeat = repeat
+        self.samples = samples
+        self.random = random.Random(seed)
+        if branch == None:
+            head = open(os.path.join(gitdir, "HEAD")).readline().strip()
+            branch = head[len("ref: refs/heads/"):] if head.startswith("ref: refs/heads/") else "HEAD"
+        self.branch = branch
+        repo = GitRepo(gitdir)
+        self.commits = repo.list_commits(branch)
+        if not self.commits:
+            repo.close()
+            raise ValueError("No commits found on branch %s" % branch)
+        self.head = self.commits[0].objid
+        self.first = self.commits[-1].objid
+        objids = [objid for objid, loc in repo.iterpackobjs()] + list(repo.iterlooseobjs())
+        self.objids = self.random.sample(objids, min(self.samples, len(objids)))
+        diffs = repo.compare_commits(self.commits[min(len(self.commits) - 1, 20)].objid, self.head)
+        self.historypath = diffs[0].filepath if diffs else None
+        repo.close()
+
+    def cases(self):
+        def startup():
+            GitRepo(self.gitdir).close()
+
+        def readobj():
+            repo = GitRepo(self.gitdir)
+            for objid in self.objids:
+                repo.readobj(objid)
+            repo.close()
+
+        def list_commits():
+            repo = GitRepo(self.gitdir)
+            repo.list_commits(self.branch)
+            repo.close()
+
+        def list_file_history():
+            repo = GitRepo(self.gitdir)
+            repo.list_file_history(self.head, self.historypath)
+            repo.close()
+
+        def compare_commits():
+            repo = GitRepo(self.gitdir)
+            repo.compare_commits(self.first, self.head)
+            repo.close()
+
+        def itercommitobjs():
+            repo = GitRepo(self.gitdir)
+            for commit in repo.itercommitobjs():
+                pass
+            repo.close()
+
+        cases = [("startup", startup), ("readobj", readobj), ("list_commits", list_commits),
+                 ("list_file_history", list_file_history), ("compare_commits", compare_commits),
+                 ("itercommitobjs", itercommitobjs)]
+        if self.historypath == None:
+            cases = [case for case in cases if case[0] != "list_file_history"]
+        return cases
+
+    def gitcases(self):
+        objinput = "".join(objid.hex() + "\n" for objid in self.objids).encode()
+        cases = {
+            "startup": (["rev-parse", "HEAD"], None),
+            "readobj": (["cat-file", "--batch"], objinput),
+            "list_commits": (["rev-list", "--first-parent", self.branch], None),
+            "list_file_history": (["log", "--first-parent", "--format=%H", self.branch, "--", self.historypath], None),
+            "compare_commits": (["diff", "--name-status", "--no-renames", self.first.hex(), self.head.hex()], None),
+            "itercommitobjs": (["rev-list", "--all"], None),
+        }
+        if self.historypath == None:
+            del cases["list_file_history"]
+        return cases
+
+    def timeit(self, func):
+        runs = []
+        for i in range(self.repeat):
+            start = time.perf_counter()
+            func()
+            runs.append(time.perf_counter() - start)
+        return runs
+
+    def peakmemory(self, func):
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def run(self, withgit=False):
+        results = {}
+        for name, func in self.cases():
+            runs = self.timeit(func)
+            results[name] = {"seconds": sorted(runs)[len(runs) // 2], "runs": runs, "peakbytes": self.peakmemory(func)}
+            print("%-20s %10.4fs %10.1fMB" % (name, results[name]["seconds"], results[name]["peakbytes"] / 1048576.0))
+        if withgit:
+            for name, (args, stdin) in self.gitcases().items():
+                cmd = ["git", "--git-dir", self.gitdir] + args
+
+                def rungit():
+                    subprocess.run(cmd, input=stdin, stdout=subprocess.DEVNULL, check=True)
+                runs = self.timeit(rungit)
+                results[name]["git_seconds"] = sorted(runs)[len(runs) // 2]
+                print("%-20s %10.4fs (git)" % (name, results[name]["git_seconds"]))
+        return results
+
+
+def compare(results, baseline, threshold):
+    regressions = 0
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if not old:
+            continue
+        ratio = result["seconds"] / old["seconds"] if old["seconds"] else 1.0
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "REGRESSION"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            mark = "faster"
+        print("%-20s %10.4fs -> %10.4fs %6.2fx %s" % (name, old["seconds"], result["seconds"], ratio, mark))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark gittool on a generated repository")
+    parser.add_argument("--commits", type=int, default=500)
+    parser.add_argument("--width", type=int, default=8, help="files per directory")
+    parser.add_argument("--depth", type=int, default=3, help="levels of nested directories")
+    parser.add_argument("--fanout", type=int, default=2, help="subdirectories per directory")
+    parser.add_argument("--changes", type=int, default=3, help="files modified per commit")
+    parser.add_argument("--delta-depth", type=int, default=10, help="maximum delta chain length in the pack")
+    parser.add_argument("--layout", choices=["pack", "loose"], default="pack")
+    parser.add_argument("--blob-size", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--samples", type=int, default=2000, help="objects read by the readobj case")
+    parser.add_argument("--git", action="store_true", help="also time the equivalent git commands")
+    parser.add_argument("--repo", help="benchmark an existing repository instead of generating one")
+    parser.add_argument("--branch", help="branch to walk, the branch HEAD points to by default")
+    parser.add_argument("--workdir", help="where to generate the repository (kept afterwards)")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare against a previous JSON result")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    params = {k: v for k, v in vars(args).items() if k not in ("output", "compare", "threshold", "workdir")}
+    baseline = None
+    if args.compare:
+        baseline = json.load(open(args.compare))
+        ignored = ("repeat", "git")
+        oldparams = baseline.get("params", {})
+        changed = sorted(k for k in set(params) | set(oldparams) if k not in ignored and params.get(k) != oldparams.get(k))
+        if changed:
+            sys.exit("%s was recorded with different parameters: %s" % (args.compare, ", ".join(
+                "%s=%s (now %s)" % (k, oldparams.get(k), params.get(k)) for k in changed)))
+    tmpdir = None
+    gitdir = args.repo
+    if gitdir == None:
+        workdir = args.workdir
+        if workdir == None:
+            workdir = tmpdir = tempfile.mkdtemp(prefix="gitbench")
+        gitdir = os.path.join(workdir, "bench.git")
+        start = time.perf_counter()
+        SyntheticRepo(gitdir, args.commits, args.width, args.depth, args.fanout, args.changes,
+                      args.delta_depth, args.layout, args.blob_size, args.seed).generate()
+        print("generated %s in %.1fs" % (gitdir, time.perf_counter() - start))
+    try:
+        results = Benchmark(gitdir, args.repeat, args.samples, args.seed, args.branch).run(args.git)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "results": results,
+    }
+    if resource:
+        report["maxrss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if args.output:
+        json.dump(report, open(args.output, "w"), indent=2)
+    if baseline:
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
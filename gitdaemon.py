@@ -0,0 +1,200 @@
+import os, json, socket, asyncio, threading, base64, argparse
+from struct import pack, unpack
+from concurrent.futures import ThreadPoolExecutor
+from gittool import GitRepo, GitError, GitCommitObject, GitTreeObject
+
+SOCKETPATH = os.path.join(os.path.expanduser("~"), ".gittool.sock")
+MAXFRAME = 1 << 30
+
+
+def hexid(objid):
+    return objid.hex() if objid else None
+
+
+def commitdict(commit):
+    return {
+        "id": hexid(commit.objid),
+        "tree": hexid(commit.tree),
+        "parent": hexid(commit.parent),
+        "mergefrom": hexid(commit.mergefrom),
+        "author": commit.author,
+        "committer": commit.committer,
+        "createtime": commit.createtime,
+        "committime": commit.committime,
+        "msg": commit.msg,
+    }
+
+
+def diffdict(diff):
+    return {
+        "commitid": hexid(diff.commitid),
+        "filepath": diff.filepath,
+        "method": diff.method,
+        "fileid1": hexid(diff.fileid1),
+        "fileid2": hexid(diff.fileid2),
+    }
+
+
+class WarmRepo:
+    def __init__(self, path):
+        self.repo = GitRepo(path)
+        self.lock = threading.Lock()
+
+
+class GitDaemon:
+    def __init__(self, socketpath=SOCKETPATH, workers=4):
+        self.socketpath = socketpath
+        self.repos = {}
+        self.reposlock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def getrepo(self, path):
+        path = os.path.abspath(path)
+        with self.reposlock:
+            if path not in self.repos:
+                self.repos[path] = WarmRepo(path)
+            return self.repos[path]
+
+    def resolve(self, repo, name):
+        objid = repo.resolveobj(name)
+        if objid == None:
+            raise GitError("Unknown object: %s" % name)
+        return objid
+
+    def resolvecommit(self, repo, name):
+        commitid = repo.resolvecommit(name)
+        if commitid == None:
+            raise GitError("Unknown commit: %s" % name)
+        return commitid
+
+    def reload(self, path):
+        path = os.path.abspath(path)
+        with self.reposlock:
+            old = self.repos.pop(path, None)
+        if old:
+            with old.lock:
+                old.repo.close()
+        self.getrepo(path)
+        return True
+
+    def runquery(self, query):
+        op = query["op"]
+        if op == "reload":
+            return self.reload(query["repo"])
+        warm = self.getrepo(query["repo"])
+        repo = warm.repo
+        with warm.lock:
+            if op == "refs":
+                return {
+                    "branches": {k: v.hex() for k, v in repo.branches.items()},
+                    "tags": {k: v.hex() for k, v in repo.tags.items()},
+                }
+            if op == "readobj":
+                obj = repo.readobj(self.resolve(repo, query["id"]))
+                if obj == None:
+                    return None
+                ret = {"id": obj.objid.hex(), "type": type(obj).type.name, "size": len(obj.raw)}
+                if isinstance(obj, GitCommitObject):
+                    ret["commit"] = commitdict(obj)
+                elif isinstance(obj, GitTreeObject):
+                    ret["children"] = {k: ["%06o" % v[0], v[1].hex()] for k, v in obj.children.items()}
+                if query.get("raw", True):
+                    ret["raw"] = base64.b64encode(obj.raw).decode()
+                return ret
+            if op == "list_commits":
+                commits = repo.list_commits(query["branch"], query.get("parent"))
+                return [commitdict(c) for c in commits]
+            if op == "compare_commits":
+                old = self.resolvecommit(repo, query["old"]) if query.get("old") else None
+                new = self.resolvecommit(repo, query["new"]) if query.get("new") else None
+                return [diffdict(d) for d in repo.compare_commits(old, new)]
+            if op == "compare_commit_with_prev":
+                return [diffdict(d) for d in repo.compare_commit_with_prev(self.resolvecommit(repo, query["id"]))]
+            if op == "list_file_history":
+                diffs = repo.list_file_history(self.resolvecommit(repo, query["id"]), query["path"])
+                return [diffdict(d) for d in diffs]
+        raise ValueError("Unknown op: " + op)
+
+    def runbatch(self, queries):
+        results = []
+        for query in queries:
+            try:
+                results.append({"ok": self.runquery(query)})
+            except Exception as e:
+                results.append({"error": "%s: %s" % (type(e).__name__, e)})
+        return results
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(4)
+                except asyncio.IncompleteReadError:
+                    break
+                size = unpack(">I", header)[0]
+                if size > MAXFRAME:
+                    break
+                queries = json.loads(await reader.readexactly(size))
+                results = await loop.run_in_executor(self.executor, self.runbatch, queries)
+                payload = json.dumps(results).encode()
+                writer.write(pack(">I", len(payload)) + payload)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.socketpath):
+            os.remove(self.socketpath)
+        server = await asyncio.start_unix_server(self.handle, path=self.socketpath)
+        os.chmod(self.socketpath, 0o600)
+        async with server:
+            await server.serve_forever()
+
+
+class GitDaemonClient:
+    def __init__(self, socketpath=SOCKETPATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socketpath)
+
+    def close(self):
+        self.sock.close()
+
+    def recvexactly(self, size):
+        buf = []
+        while size > 0:
+            data = self.sock.recv(min(size, 1 << 20))
+            if not data:
+                raise ConnectionError("gitdaemon closed the connection")
+            buf.append(data)
+            size -= len(data)
+        return b''.join(buf)
+
+    def batch(self, queries):
+        payload = json.dumps(queries).encode()
+        self.sock.sendall(pack(">I", len(payload)) + payload)
+        size = unpack(">I", self.recvexactly(4))[0]
+        return json.loads(self.recvexactly(size))
+
+    def query(self, repo, op, **args):
+        args["repo"] = repo
+        args["op"] = op
+        result = self.batch([args])[0]
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result["ok"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve gittool queries from warm repositories over a unix socket")
+    parser.add_argument("--socket", default=SOCKETPATH)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("repos", nargs="*", help="repositories to open before serving")
+    args = parser.parse_args()
+    daemon = GitDaemon(args.socket, args.workers)
+    for path in args.repos:
+        daemon.getrepo(path)
+    try:
+        asyncio.run(daemon.serve())
+    except KeyboardInterrupt:
+        pass
@@ -3,19 +3,150 @@ from tkinter import filedialog
 from tkinter import messagebox
 from tkinter import ttk
 from tkinter.scrolledtext import ScrolledText
-from gittool import GitRepo
-import os, subprocess
+from gittool import GitRepo, GitCancelled
+from concurrent.futures import ThreadPoolExecutor
+import os, subprocess, threading, queue, bisect
 from datetime import datetime
 import time
 DIFFTOOL = "D:\\vscode\\workspace\\gittool\\windiff.exe"
 EDITTOOL = "C:\\Program Files\\EditPlus 3\\editplus.exe"
 MERGETOOL = "C:\\Program Files\\Perforce\\p4merge.exe"
 GITCMD = "git.exe"
+FIRSTPAGE = 100
+PAGESIZE = 1000
+MAXMATCHES = 5000
+MAXBASES = 20
+
+class BackgroundTask:
+
+    def __init__(self, top, executor, func, onitems, ondone, taskbar, batchsize, title, firstbatch):
+        self.top = top
+        self.title = title
+        self.onitems = onitems
+        self.ondone = ondone
+        self.taskbar = taskbar
+        self.batchsize = batchsize
+        self.firstbatch = firstbatch
+        self.count = 0
+        self.cancel = threading.Event()
+        self.items = queue.Queue()
+        self.future = executor.submit(func, self.cancel, self.items.put)
+        if self.taskbar:
+            self.taskbar.start(self)
+        self.top.after(10, self.poll)
+
+    def running(self):
+        return not self.cancel.is_set()
+
+    def stop(self):
+        if not self.cancel.is_set():
+            self.cancel.set()
+            self.finish()
+
+    def finish(self):
+        if self.taskbar:
+            self.taskbar.stop(self)
+
+    def poll(self):
+        if self.cancel.is_set():
+            return
+        done = self.future.done()
+        batchsize = self.firstbatch if self.count == 0 and self.firstbatch else self.batchsize
+        items = []
+        try:
+            while len(items) < batchsize:
+                items.append(self.items.get_nowait())
+        except queue.Empty:
+            pass
+        if items:
+            self.count += len(items)
+            self.onitems(items)
+            if self.taskbar:
+                self.taskbar.update(self.count)
+        if self.cancel.is_set():
+            return
+        if len(items) == batchsize:
+            self.top.after(1, self.poll)
+        elif not done:
+            self.top.after(10 if self.count == 0 else 50, self.poll)
+        else:
+            self.cancel.set()
+            self.finish()
+            try:
+                result = self.future.result()
+            except GitCancelled:
+                return
+            except Exception as e:
+                messagebox.showerror("Error", "%s: %s" % (type(e).__name__, e))
+                return
+            if self.ondone:
+                self.ondone(result)
+
+
+class TaskExecutor:
+
+    def __init__(self, top, workers=4):
+        self.top = top
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.tasks = []
+
+    def submit(self, func, onitems, ondone=None, taskbar=None, batchsize=PAGESIZE, title=None, firstbatch=None):
+        self.tasks = [t for t in self.tasks if not t.cancel.is_set()]
+        task = BackgroundTask(self.top, self.executor, func, onitems, ondone, taskbar, batchsize, title, firstbatch)
+        self.tasks.append(task)
+        return task
+
+    def cancelall(self):
+        for task in self.tasks:
+            task.cancel.set()
+        self.tasks = []
+
+
+class TaskBar:
+
+    def __init__(self, parent, text, before=None):
+        self.text = text
+        self.before = before
+        self.task = None
+        self.frame = ttk.Frame(parent)
+        self.progress = ttk.Progressbar(self.frame, mode="indeterminate", length=150)
+        self.progress.pack(side="left")
+        self.label1 = ttk.Label(self.frame)
+        self.label1.pack(side="left", padx=(10, 0))
+        self.btnCancel = ttk.Button((self.frame), command=(self.On_btnCancel_click))
+        self.btnCancel.configure(text="Cancel")
+        self.btnCancel.pack(side="right")
+
+    def start(self, task):
+        if self.task:
+            self.task.stop()
+        self.task = task
+        self.label1.configure(text=task.title or self.text)
+        if self.before:
+            self.frame.pack(side="bottom", fill="x", before=self.before)
+        else:
+            self.frame.pack(side="bottom", fill="x")
+        self.progress.start(20)
+
+    def update(self, count):
+        self.label1.configure(text="%s %d" % (self.task.title or self.text, count))
+
+    def stop(self, task):
+        if self.task == task:
+            self.task = None
+            self.progress.stop()
+            self.frame.pack_forget()
+
+    def On_btnCancel_click(self):
+        if self.task:
+            self.task.stop()
+
 
 class BaseWnd:
     def ShowDialog(self, typeobj):
         popup = tk.Toplevel(self.top)
         wnd = typeobj(popup)
+        wnd.tasks = self.tasks
         popup.focus_force()
         popup.grab_set()
         return wnd
@@ -92,13 +223,31 @@ class CommitDetailWnd(BaseWnd):
         self.treeview1menu.add_command(label="Show diff", command=(self.On_treeView1_showDiffs))
         self.treeview1menu.add_command(label="View file", command=(self.On_treeView1_viewfile))
         self.treeview1menu.add_command(label="View file history", command=(self.On_treeView1_viewFileHistory))
+        self.taskbar = TaskBar(top, "Comparing... changes:", self.frame1)
+        self.top.bind("<Destroy>", self.On_destroyed)
+        self.task = None
 
-    def showchanges(self, repo, diffs):
+    def loadchanges(self, repo, compare):
         self.repo = repo
+        self.diffs = []
+        self.filepaths = []
+        self.task = self.tasks.submit(compare, self.On_changes_received, self.showchanges, self.taskbar)
+
+    def On_destroyed(self, event):
+        if event.widget == self.top and self.task:
+            self.task.stop()
+
+    def On_changes_received(self, diffs):
+        for diff in diffs:
+            idx = bisect.bisect(self.filepaths, diff.filepath)
+            self.filepaths.insert(idx, diff.filepath)
+            self.diffs.insert(idx, diff)
+            self.treeview1.insert("", idx, text=(diff.method), values=(diff.filepath))
+
+    def showchanges(self, diffs):
         self.diffs = diffs
         commits = set()
         for diff in self.diffs:
-            self.treeview1.insert("", "end", text=(diff.method), values=(diff.filepath))
             commits.add(diff.commitid)
 
         messages = []
@@ -179,7 +328,10 @@ class CompareWithDlg(BaseWnd):
                 commitid = self.repo.tags[name]
         else:
             name = self.comboInput.get()
-            commitid = bytes.fromhex(name)
+            commitid = self.repo.resolvecommit(name.strip())
+            if commitid == None:
+                messagebox.showerror("Error", "Unknown commit: " + name)
+                return
         self.callback(commitid)
         self.top.destroy()
 
@@ -207,11 +359,23 @@ class ViewFileHistoryWnd(BaseWnd):
         self.treeview1menu = tk.Menu(top, tearoff=0)
         self.treeview1menu.add_command(label="Compare with prev", command=(self.On_treeView1_compareWithPrev))
         self.treeview1menu.add_command(label="View file", command=(self.On_treeView1_viewFile))
+        self.taskbar = TaskBar(top, "Reading history... revisions:", self.scroll1)
+        self.top.bind("<Destroy>", self.On_destroyed)
+        self.task = None
 
     def showhistory(self, repo, commitid, filepath):
         self.repo = repo
-        self.histories = self.repo.list_file_history(commitid, filepath)
-        for item in self.histories:
+        self.histories = []
+        history = lambda cancel, progress: self.repo.list_file_history(commitid, filepath, cancel, progress)
+        self.task = self.tasks.submit(history, self.On_history_received, None, self.taskbar)
+
+    def On_destroyed(self, event):
+        if event.widget == self.top and self.task:
+            self.task.stop()
+
+    def On_history_received(self, items):
+        self.histories += items
+        for item in items:
             commit = self.repo.readobj(item.commitid)
             createtime = self.FormatTime(commit.createtime)
             comments = [m for m in commit.msg.split("\n") if m]
@@ -245,6 +409,17 @@ class ViewFilesWnd(BaseWnd):
 
     def __init__(self, top):
         self.top = top
+        self.frame1 = ttk.Frame(top)
+        self.frame1.pack(side="top", fill="x")
+        self.label1 = ttk.Label(self.frame1)
+        self.label1.configure(text="Filter:")
+        self.label1.pack(side="left")
+        self.txtFilter = ttk.Entry(self.frame1)
+        self.txtFilter.configure(width=64)
+        self.txtFilter.pack(side="left", padx=(0, 10))
+        self.txtFilter.bind("<KeyRelease>", self.On_txtFilter_changed)
+        self.label2 = ttk.Label(self.frame1)
+        self.label2.pack(side="left")
         self.treeview1 = ttk.Treeview(self.top)
         self.scroll1 = ttk.Scrollbar((self.top), command=(self.treeview1.yview))
         self.treeview1.configure(yscrollcommand=(self.scroll1.set), height=25)
@@ -257,25 +432,92 @@ class ViewFilesWnd(BaseWnd):
         self.treeview1.heading("1", text="fileid", anchor="w")
         self.treeview1.bind("<Button-3>", self.On_treeView1_rightclicked)
         self.treeview1.bind("<Double-1>", self.On_treeView1_doubleclicked)
+        self.treeview1.bind("<<TreeviewOpen>>", self.On_treeView1_opened)
         self.scroll1.pack(side="right", fill="y")
         self.treeview1.pack(side="right", expand=1, fill="both")
         self.treeview1menu = tk.Menu(top, tearoff=0)
         self.treeview1menu.add_command(label="View file", command=(self.On_treeView1_viewFile))
         self.treeview1menu.add_command(label="View file history", command=(self.On_treeView1_viewFileHistory))
+        self.top.bind("<Destroy>", self.On_destroyed)
+        self.unexpanded = {}
+        self.pathindex = []
+        self.indextask = None
+        self.filterjob = None
+        self.filtertext = ""
 
     def expandtree(self, treeid, treeviewobj, path):
         treeobj = self.repo.readobj(treeid)
         for name in treeobj.children:
             (mode, objid) = treeobj.children[name]
-            treeid = self.treeview1.insert(treeviewobj, "end", text=name, values=("%06o" % mode, objid.hex(), path + name))
+            iid = self.treeview1.insert(treeviewobj, "end", text=name, values=("%06o" % mode, objid.hex(), path + name))
             if mode == 16384:
-                self.expandtree(objid, treeid, path + name + "/")
+                self.unexpanded[iid] = (objid, path + name + "/")
+                self.treeview1.insert(iid, "end", text="")
 
     def showFiles(self, repo, commitid):
         self.repo = repo
         self.commitid = commitid
         commit = self.repo.readobj(commitid)
-        self.expandtree(commit.tree, "", "")
+        self.tree = commit.tree
+        self.expandtree(self.tree, "", "")
+        self.indextask = self.tasks.submit(self.BuildPathIndex, self.pathindex.extend, batchsize=PAGESIZE * 20)
+
+    def BuildPathIndex(self, cancel, progress):
+        for entry in self.repo.walk_tree(self.tree):
+            if cancel.is_set():
+                return
+            progress(entry)
+
+    def On_destroyed(self, event):
+        if event.widget == self.top:
+            if self.indextask:
+                self.indextask.stop()
+            if self.filterjob:
+                self.top.after_cancel(self.filterjob)
+
+    def On_treeView1_opened(self, event):
+        iid = self.treeview1.focus()
+        if iid in self.unexpanded:
+            (treeid, path) = self.unexpanded.pop(iid)
+            (self.treeview1.delete)(*self.treeview1.get_children(iid))
+            self.expandtree(treeid, iid, path)
+
+    def On_txtFilter_changed(self, event):
+        if self.filterjob:
+            self.top.after_cancel(self.filterjob)
+        self.filterjob = self.top.after(300, self.ApplyFilter)
+
+    def ApplyFilter(self):
+        self.filterjob = None
+        filtertext = self.txtFilter.get().strip().lower()
+        if filtertext == self.filtertext:
+            return
+        self.filtertext = filtertext
+        self.unexpanded = {}
+        (self.treeview1.delete)(*self.treeview1.get_children())
+        self.label2.configure(text="")
+        if not filtertext:
+            self.expandtree(self.tree, "", "")
+            return
+        self.filterjob = self.top.after(0, self.FilterMore, filtertext, 0, 0)
+
+    def FilterMore(self, filtertext, pos, matches):
+        self.filterjob = None
+        done = not self.indextask.running()
+        end = len(self.pathindex)
+        for (path, mode, objid) in self.pathindex[pos:end]:
+            if matches >= MAXMATCHES:
+                break
+            if filtertext in path.lower():
+                self.treeview1.insert("", "end", text=path, values=("%06o" % mode, objid.hex(), path))
+                matches += 1
+        if matches >= MAXMATCHES:
+            self.label2.configure(text="First %d matches" % matches)
+        elif done:
+            self.label2.configure(text="%d matches" % matches)
+        else:
+            self.label2.configure(text="%d matches, %d paths indexed..." % (matches, end))
+            self.filterjob = self.top.after(200, self.FilterMore, filtertext, end, matches)
 
     def On_treeView1_rightclicked(self, event):
         iid = self.treeview1.identify_row(event.y)
@@ -376,6 +618,13 @@ class AppMainWnd(BaseWnd):
         self.treeview1menu.add_command(label="Compare with...", command=(self.On_treeView1menu_compareWith))
         self.treeview1menu.add_command(label="View files", command=(self.On_treeView1menu_viewFiles))
         self.treeview1menu.add_command(label="Copy commit ID", command=(self.On_treeView1menu_copyCommitID))
+        self.tasks = TaskExecutor(top)
+        self.taskbar = TaskBar(top, "Loading commits...", self.mainpannel)
+        self.loadtask = None
+        self.suggesttask = None
+        self.autoparent = True
+        self.commits = []
+        self.committers = set()
 
     def On_treeView1_ctrlc(self, args):
         lines = []
@@ -387,6 +636,11 @@ class AppMainWnd(BaseWnd):
         self.top.clipboard_append("\n".join(lines))
 
     def ReloadAll(self):
+        if self.loadtask:
+            self.loadtask.stop()
+        if self.suggesttask:
+            self.suggesttask.stop()
+        self.commits = []
         self.label1.configure(text=(self.folderpath))
         self.repo = GitRepo(self.folderpath)
         self.comboBranch.configure(values=(list(self.repo.branches) + list(self.repo.tags)))
@@ -394,6 +648,7 @@ class AppMainWnd(BaseWnd):
         self.branches2 = ["N/A"] + list(self.repo.branches)
         self.comboParentBranch.configure(values=(self.branches2))
         self.comboParentBranch.set("")
+        self.autoparent = True
         self.comboCommitter.configure(values=[])
         self.comboCommitter.set("")
         (self.treeview1.delete)(*self.treeview1.get_children())
@@ -452,26 +707,83 @@ class AppMainWnd(BaseWnd):
         if self.comboBranch.current() < 0:
             return
         branchname = self.comboBranch.get()
+        if event.widget == self.comboParentBranch:
+            self.autoparent = False
+        if event.widget != self.comboCommitter:
+            self.comboCommitter.configure(values=[])
+            self.comboCommitter.set("")
+        if event.widget == self.comboBranch and self.autoparent:
+            self.comboParentBranch.set("")
+            self.LoadCommits(branchname, None, "ALL")
+            self.SuggestParent(branchname)
+            return
         basename = None
         if self.comboParentBranch.current() > 0:
             basename = self.comboParentBranch.get()
-        committer = set()
-        self.commits = self.repo.list_commits(branchname, basename)
-        for commit in self.commits:
-            committer.add(commit.author)
-
-        self.comboCommitter.configure(values=(["ALL"] + sorted(list(committer))))
         committerfilter = "ALL"
         if self.comboCommitter.current() > 0:
             committerfilter = self.comboCommitter.get()
+        self.LoadCommits(branchname, basename, committerfilter)
+
+    def SuggestParent(self, branchname):
+        if self.suggesttask:
+            self.suggesttask.stop()
+        suggest = lambda cancel, progress: self.SuggestParentThread(self.repo, branchname)
+        ondone = lambda forkpoint: self.On_parent_suggested(branchname, forkpoint)
+        self.suggesttask = self.tasks.submit(suggest, None, ondone)
+
+    def SuggestParentThread(self, repo, branchname):
+        tips = []
+        for name, commitid in repo.branches.items():
+            if name != branchname:
+                commitid = repo.resolvecommit(commitid)
+                if commitid:
+                    tips.append((repo.readobj(commitid).committime or 0, name, commitid))
+        tips.sort(reverse=True)
+        bases = []
+        seen = set()
+        for (committime, name, commitid) in tips:
+            if commitid not in seen:
+                seen.add(commitid)
+                bases.append(name)
+                if len(bases) == MAXBASES:
+                    break
+        return repo.getreachability().fork_point(branchname, bases)
+
+    def On_parent_suggested(self, branchname, forkpoint):
+        if not self.autoparent or self.comboBranch.get() != branchname or forkpoint == None:
+            return
+        self.comboParentBranch.set(forkpoint[0])
+        self.LoadCommits(branchname, forkpoint[0], "ALL")
+
+    def LoadCommits(self, branchname, basename, committerfilter):
+        if self.loadtask:
+            self.loadtask.stop()
+        self.commits = []
+        self.committers = set()
+        self.committerfilter = committerfilter
         (self.treeview1.delete)(*self.treeview1.get_children())
-        for commit in self.commits:
-            if not committerfilter == "ALL":
-                if committerfilter == commit.author:
-                    pass
+        load = lambda cancel, progress: self.LoadCommitsThread(self.repo, branchname, basename, cancel, progress)
+        self.loadtask = self.tasks.submit(load, self.On_commits_received, None, self.taskbar, firstbatch=FIRSTPAGE)
+
+    def LoadCommitsThread(self, repo, branchname, basename, cancel, progress):
+        for commit in repo.iter_commits(branchname, basename):
+            if cancel.is_set():
+                return
+            progress(commit)
+
+    def On_commits_received(self, page):
+        self.commits += page
+        committers = len(self.committers)
+        for commit in page:
+            self.committers.add(commit.author)
+            if self.committerfilter != "ALL" and self.committerfilter != commit.author:
+                continue
             createtime = self.FormatTime(commit.createtime)
             comments = self.FormatComments(commit)
             self.treeview1.insert("", "end", text=(commit.objid.hex()), values=(createtime, commit.author + ("/" + commit.committer if commit.committer else ""), comments))
+        if len(self.committers) != committers:
+            self.comboCommitter.configure(values=(["ALL"] + sorted(list(self.committers))))
 
     def On_treeView1_rightclicked(self, event):
         iid = self.treeview1.identify_row(event.y)
@@ -489,8 +801,8 @@ class AppMainWnd(BaseWnd):
     def On_treeView1menu_compareWithPrev(self):
         wnd = self.ShowDialog(CommitDetailWnd)
         commitid = bytes.fromhex(self.selected_item)
-        diffs = self.repo.compare_commit_with_prev(commitid)
-        wnd.showchanges(self.repo, diffs)
+        compare = lambda cancel, progress: self.repo.compare_commit_with_prev(commitid, cancel, progress)
+        wnd.loadchanges(self.repo, compare)
 
     def On_treeView1menu_compareWith(self):
         wnd = self.ShowDialog(CompareWithDlg)
@@ -498,9 +810,9 @@ class AppMainWnd(BaseWnd):
 
     def On_CompareWith_selected(self, commitid):
         selectedid = bytes.fromhex(self.selected_item)
-        diffs = self.repo.compare_commits(commitid, selectedid)
+        compare = lambda cancel, progress: self.repo.compare_commits(commitid, selectedid, cancel, progress)
         wnd = self.ShowDialog(CommitDetailWnd)
-        wnd.showchanges(self.repo, diffs)
+        wnd.loadchanges(self.repo, compare)
 
     def On_treeView1menu_viewFiles(self):
         commitid = bytes.fromhex(self.selected_item)
@@ -518,3 +830,4 @@ if __name__ == "__main__":
     root.geometry("800x600")
     top = AppMainWnd(root)
     root.mainloop()
+    top.tasks.cancelall()
@@ -0,0 +1,207 @@
+import re, sys, argparse
+from array import array
+from collections import Counter
+from datetime import datetime, timezone
+from gittool import GitRepo, GitError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DAY = 86400
+WEEK = 7 * DAY
+MONDAY = 4 * DAY
+AUTHORRE = re.compile(rb"\nauthor ([^<\n]*?) ?<[^>\n]*> (\d+)")
+COMMITTERRE = re.compile(rb"\ncommitter [^<\n]*<[^>\n]*> (\d+)")
+PARENTRE = re.compile(rb"\nparent ([0-9a-f]{40})")
+
+
+class CommitTable:
+    def __init__(self, authors=None):
+        self.ids = bytearray()
+        self.authortime = array("q")
+        self.committime = array("q")
+        self.author = array("I")
+        self.parents = array("B")
+        self.authors = authors if authors != None else []
+        self.authorindex = {name: i for i, name in enumerate(self.authors)}
+
+    def __len__(self):
+        return len(self.authortime)
+
+    def commitid(self, i):
+        return bytes(self.ids[i * 20:i * 20 + 20])
+
+    def internauthor(self, name):
+        i = self.authorindex.get(name)
+        if i == None:
+            i = self.authorindex[name] = len(self.authors)
+            self.authors.append(name)
+        return i
+
+    def add(self, objid, raw):
+        end = raw.find(b"\n\n")
+        header = b"\n" + (raw if end < 0 else raw[:end])
+        author = AUTHORRE.search(header)
+        committer = COMMITTERRE.search(header)
+        parents = PARENTRE.findall(header)
+        self.ids += objid
+        self.authortime.append(int(author[2]) if author else 0)
+        self.committime.append(int(committer[1]) if committer else 0)
+        self.author.append(self.internauthor(author[1].decode(errors="replace") if author else ""))
+        self.parents.append(min(len(parents), 255))
+        return [bytes.fromhex(p.decode()) for p in parents]
+
+    def addall(self, repo):
+        for objid, raw in repo.itercommitraw():
+            self.add(objid, raw)
+
+    def addref(self, repo, ref, exclude=None):
+        commitid = repo.resolvecommit(ref)
+        if commitid == None:
+            raise GitError("Unknown commit: %s" % ref)
+        reachindex = None
+        if exclude:
+            excludeid = repo.resolvecommit(exclude)
+            if excludeid == None:
+                raise GitError("Unknown commit: %s" % exclude)
+            reachindex = repo.getreachability()
+            excluded = reachindex.reach(excludeid, True)
+        seen = set()
+        stack = [commitid]
+        while stack:
+            c = stack.pop()
+            if c in seen:
+                continue
+            seen.add(c)
+            if reachindex and excluded >> reachindex.number(c) & 1:
+                continue
+            stack += self.add(c, repo.readobjraw(c)[1])
+
+    def finish(self):
+        if numpy != None:
+            self.authortime = numpy.array(self.authortime, dtype=numpy.int64)
+            self.committime = numpy.array(self.committime, dtype=numpy.int64)
+            self.author = numpy.array(self.author, dtype=numpy.uint32)
+            self.parents = numpy.array(self.parents, dtype=numpy.uint8)
+        return self
+
+    def select(self, rows):
+        table = CommitTable(self.authors)
+        table.authorindex = self.authorindex
+        if numpy != None:
+            rows = numpy.asarray(rows, dtype=numpy.int64)
+            ids = numpy.frombuffer(bytes(self.ids), dtype="S20")
+            table.ids = bytearray(ids[rows].tobytes())
+            table.authortime = numpy.asarray(self.authortime)[rows]
+            table.committime = numpy.asarray(self.committime)[rows]
+            table.author = numpy.asarray(self.author)[rows]
+            table.parents = numpy.asarray(self.parents)[rows]
+            return table
+        for i in rows:
+            table.ids += self.ids[i * 20:i * 20 + 20]
+        table.authortime = array("q", [self.authortime[i] for i in rows])
+        table.committime = array("q", [self.committime[i] for i in rows])
+        table.author = array("I", [self.author[i] for i in rows])
+        table.parents = array("B", [self.parents[i] for i in rows])
+        return table
+
+    def window(self, start, end, column="authortime"):
+        times = getattr(self, column)
+        if numpy != None:
+            times = numpy.asarray(times)
+            return self.select(numpy.flatnonzero((times >= start) & (times < end)))
+        return self.select([i for i, t in enumerate(times) if start <= t < end])
+
+    def byauthor(self, name):
+        authorid = self.authorindex.get(name)
+        if numpy != None:
+            return self.select(numpy.flatnonzero(numpy.asarray(self.author) == authorid))
+        return self.select([i for i, a in enumerate(self.author) if a == authorid])
+
+    def merges(self):
+        if numpy != None:
+            return self.select(numpy.flatnonzero(numpy.asarray(self.parents) > 1))
+        return self.select([i for i, p in enumerate(self.parents) if p > 1])
+
+    def shortlog(self):
+        if numpy != None:
+            counts = numpy.bincount(numpy.asarray(self.author, dtype=numpy.int64), minlength=len(self.authors)).tolist()
+        else:
+            counter = Counter(self.author)
+            counts = [counter[i] for i in range(len(self.authors))]
+        ret = [(self.authors[i], counts[i]) for i in range(len(self.authors)) if counts[i]]
+        ret.sort(key=lambda x: (-x[1], x[0]))
+        return ret
+
+    def histogram(self, bucket=WEEK, column="authortime", byauthor=False):
+        times = getattr(self, column)
+        if len(times) == 0:
+            return (0, [])
+        align = MONDAY if bucket % WEEK == 0 else 0
+        if numpy != None:
+            times = numpy.asarray(times)
+            origin = (int(times.min()) - align) // bucket * bucket + align
+            bins = (times - origin) // bucket
+            n = int(bins.max()) + 1
+            if byauthor:
+                keys = numpy.asarray(self.author, dtype=numpy.int64) * n + bins
+                return (origin, numpy.bincount(keys, minlength=len(self.authors) * n).reshape(len(self.authors), n))
+            return (origin, numpy.bincount(bins, minlength=n))
+        origin = (min(times) - align) // bucket * bucket + align
+        bins = [(t - origin) // bucket for t in times]
+        n = max(bins) + 1
+        if byauthor:
+            counter = Counter(a * n + b for a, b in zip(self.author, bins))
+            return (origin, [[counter[a * n + b] for b in range(n)] for a in range(len(self.authors))])
+        counter = Counter(bins)
+        return (origin, [counter[b] for b in range(n)])
+
+
+def loadcommits(repo, revrange=None):
+    table = CommitTable()
+    if revrange == None:
+        table.addall(repo)
+    elif ".." in revrange:
+        (exclude, ref) = revrange.split("..", 1)
+        table.addref(repo, ref or "HEAD", exclude or "HEAD")
+    else:
+        table.addref(repo, revrange)
+    return table.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate commit statistics over a columnar commit table")
+    parser.add_argument("repo", help="path to the .git directory")
+    parser.add_argument("revrange", nargs="?", help="ref or A..B range, all commits in the object store by default")
+    parser.add_argument("--since", help="only count commits authored on or after YYYY-MM-DD")
+    parser.add_argument("--until", help="only count commits authored before YYYY-MM-DD")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("shortlog", help="commit count per author")
+    activity = subparsers.add_parser("activity", help="commit count per time bucket")
+    activity.add_argument("--bucket", choices=["day", "week"], default="week")
+    activity.add_argument("--author", help="only count commits by this author")
+    args = parser.parse_args()
+
+    repo = GitRepo(args.repo)
+    try:
+        table = loadcommits(repo, args.revrange)
+    except GitError as e:
+        sys.exit(str(e))
+    if args.since or args.until:
+        start = datetime.strptime(args.since, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() if args.since else 0
+        end = datetime.strptime(args.until, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() if args.until else 1 << 62
+        table = table.window(int(start), int(end))
+    if args.command == "shortlog":
+        for name, count in table.shortlog():
+            print("%6d\t%s" % (count, name))
+    else:
+        if args.author:
+            table = table.byauthor(args.author)
+        bucket = DAY if args.bucket == "day" else WEEK
+        (origin, counts) = table.histogram(bucket)
+        for i, count in enumerate(counts):
+            if count:
+                print("%s %d" % (datetime.fromtimestamp(origin + i * bucket, timezone.utc).strftime("%Y-%m-%d"), count))
+    repo.close()
@@ -1,10 +1,47 @@
-import os, glob, zlib, re
+import os, sys, stat, glob, zlib, re, mmap, time, threading, fnmatch, tarfile
 from datetime import datetime
 from datetime import timezone
 from io import StringIO, BytesIO
 from enum import IntEnum
-from struct import unpack
-from functools import lru_cache
+from struct import pack, unpack, unpack_from
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from hashlib import sha1
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+class GitError(Exception):
+    pass
+
+
+class GitCancelled(GitError):
+    pass
+
+
+def checkcancel(cancel):
+    if cancel and cancel.is_set():
+        raise GitCancelled("Operation cancelled")
+
+
+def matchpathspec(path, pathspec, isdir=False):
+    for spec in pathspec:
+        spec = spec.strip("/")
+        if spec == "" or path == spec or path.startswith(spec + "/"):
+            return True
+        wildcard = re.search("[*?[]", spec)
+        if wildcard == None:
+            if isdir and spec.startswith(path + "/"):
+                return True
+            continue
+        if fnmatch.fnmatchcase(path, spec):
+            return True
+        if isdir:
+            literal = spec[:wildcard.start()]
+            if literal.startswith(path + "/") or (path + "/").startswith(literal[:literal.rfind("/") + 1]):
+                return True
+    return False
+
 
 class GitObjectType(IntEnum):
     commit = 1
@@ -150,27 +187,917 @@ class GitBlobObject:
         self.raw = raw
 
 
-class GitRepo:
+def popcount(bitmap):
+    if hasattr(bitmap, "bit_count"):
+        return bitmap.bit_count()
+    return bin(bitmap).count("1")
+
+
+def iterbits(bitmap):
+    buf = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for i in range(len(buf)):
+        c = buf[i]
+        while c:
+            low = c & -c
+            yield i * 8 + low.bit_length() - 1
+            c ^= low
+
+
+def ewahdecode(buf, off=0):
+    (bitsize, wordnum) = unpack_from(">II", buf, off)
+    words = unpack_from(">%dQ" % wordnum, buf, off + 8)
+    out = array("Q", bytes(8 * ((bitsize + 63) // 64)))
+    pos = 0
+    i = 0
+    while i < wordnum:
+        rlw = words[i]
+        runlen = rlw >> 1 & 0xFFFFFFFF
+        litnum = rlw >> 33
+        if rlw & 1:
+            for j in range(pos, pos + runlen):
+                out[j] = 0xFFFFFFFFFFFFFFFF
+        pos += runlen
+        for j in range(litnum):
+            out[pos + j] = words[i + 1 + j]
+        pos += litnum
+        i += 1 + litnum
+    if sys.byteorder != "little":
+        out.byteswap()
+    bitmap = int.from_bytes(out.tobytes(), "little")
+    return (bitmap, off + 12 + wordnum * 8)
+
+
+def ewahencode(bitmap, bitsize):
+    raw = array("Q", bitmap.to_bytes(8 * ((bitsize + 63) // 64), "little"))
+    if sys.byteorder != "little":
+        raw.byteswap()
+    words = []
+    lastrlw = 0
+    i = 0
+    while i < len(raw) or not words:
+        running = raw[i] if i < len(raw) and raw[i] in (0, 0xFFFFFFFFFFFFFFFF) else 0
+        runlen = 0
+        while i < len(raw) and raw[i] == running and runlen < 0xFFFFFFFF:
+            runlen += 1
+            i += 1
+        literals = []
+        while i < len(raw) and raw[i] not in (0, 0xFFFFFFFFFFFFFFFF) and len(literals) < 0x7FFFFFFF:
+            literals.append(raw[i])
+            i += 1
+        lastrlw = len(words)
+        words.append((len(literals) << 33) | (runlen << 1) | (1 if running else 0))
+        words += literals
+    return pack(">II%dQI" % len(words), bitsize, len(words), *words, lastrlw)
+
+
+class GitPackIndex:
+    def __init__(self, idxfile):
+        self.idxfile = idxfile
+        with open(idxfile, "rb") as fd:
+            self.buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self.buf
+        if buf[0:4] != b'\xfftOc' or buf[4:8] != b'\x00\x00\x00\x02':
+            self.close()
+            raise GitError("Invalid idx file: " + idxfile)
+        self.objnum = unpack_from(">I", buf, 1028)[0]
+        self.hasharray = 1032
+        self.crcarray = self.hasharray + 20 * self.objnum
+        self.offarray = self.crcarray + 4 * self.objnum
+        self.loffarray = self.offarray + 4 * self.objnum
+
+    def close(self):
+        self.buf.close()
+
+    def objid(self, i):
+        return self.buf[self.hasharray + i * 20:self.hasharray + i * 20 + 20]
+
+    def crc(self, i):
+        return unpack_from(">I", self.buf, self.crcarray + i * 4)[0]
+
+    def offset(self, i):
+        off = unpack_from(">I", self.buf, self.offarray + i * 4)[0]
+        if off & 0x80000000:
+            off = unpack_from(">Q", self.buf, self.loffarray + (off & 0x7FFFFFFF) * 8)[0]
+        return off
+
+    def find(self, objid):
+        first = objid[0]
+        lo = unpack_from(">I", self.buf, 8 + (first - 1) * 4)[0] if first else 0
+        hi = unpack_from(">I", self.buf, 8 + first * 4)[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.objid(mid) < objid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.objnum and self.objid(lo) == objid:
+            return lo
+        return None
+
+    def revindex(self):
+        revfile = self.idxfile[:-4] + ".rev"
+        if os.path.isfile(revfile):
+            rev = open(revfile, "rb").read()
+            if rev[0:12] == b'RIDX\x00\x00\x00\x01\x00\x00\x00\x01' and len(rev) == 12 + 4 * self.objnum + 40:
+                return list(unpack_from(">%dI" % self.objnum, rev, 12))
+        return sorted(range(self.objnum), key=self.offset)
+
+
+class GitMultiPackIndex:
+    def __init__(self, midxfile):
+        with open(midxfile, "rb") as fd:
+            self.buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self.buf
+        if buf[0:4] != b'MIDX' or buf[4] != 1 or buf[5] != 1:
+            self.close()
+            raise GitError("Invalid multi-pack-index file: " + midxfile)
+        chunknum = buf[6]
+        packnum = unpack_from(">I", buf, 8)[0]
+        chunks = {}
+        chunkends = {}
+        prev = None
+        for i in range(chunknum + 1):
+            (chunkid, chunkoff) = unpack_from(">4sQ", buf, 12 + i * 12)
+            if prev:
+                chunkends[prev] = chunkoff
+            chunks[chunkid] = chunkoff
+            prev = chunkid
+        for chunkid in (b'PNAM', b'OIDF', b'OIDL', b'OOFF'):
+            if chunkid not in chunks:
+                self.close()
+                raise GitError("Invalid multi-pack-index file: " + midxfile)
+        names = buf[chunks[b'PNAM']:chunkends[b'PNAM']].split(b'\x00')
+        self.packnames = [name.decode() for name in names[:packnum]]
+        self.fanout = chunks[b'OIDF']
+        self.oidlist = chunks[b'OIDL']
+        self.offarray = chunks[b'OOFF']
+        self.loffarray = chunks.get(b'LOFF')
+        self.objnum = unpack_from(">I", buf, self.fanout + 255 * 4)[0]
+
+    def close(self):
+        self.buf.close()
+
+    def objid(self, i):
+        return self.buf[self.oidlist + i * 20:self.oidlist + i * 20 + 20]
+
+    def entry(self, i):
+        (packid, off) = unpack_from(">II", self.buf, self.offarray + i * 8)
+        if off & 0x80000000:
+            off = unpack_from(">Q", self.buf, self.loffarray + (off & 0x7FFFFFFF) * 8)[0]
+        return (off, packid)
+
+    def lowerbound(self, objid):
+        first = objid[0]
+        lo = unpack_from(">I", self.buf, self.fanout + (first - 1) * 4)[0] if first else 0
+        hi = unpack_from(">I", self.buf, self.fanout + first * 4)[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.objid(mid) < objid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, objid):
+        i = self.lowerbound(objid)
+        if i < self.objnum and self.objid(i) == objid:
+            return self.entry(i)
+        return None
+
+    def findprefix(self, prefix):
+        i = self.lowerbound(bytes.fromhex(prefix.ljust(40, "0")))
+        while i < self.objnum:
+            objid = self.objid(i)
+            if not objid.hex().startswith(prefix):
+                break
+            yield objid
+            i += 1
+
+    def __iter__(self):
+        for i in range(self.objnum):
+            yield (self.objid(i), self.entry(i))
+
+
+class GitPackBitmap:
+    def __init__(self, bitmapfile, packindex):
+        buf = open(bitmapfile, "rb").read()
+        if buf[0:6] != b'BITM\x00\x01':
+            raise GitError("Invalid bitmap file: " + bitmapfile)
+        entrynum = unpack_from(">I", buf, 8)[0]
+        if buf[12:32] != packindex.buf[-40:-20]:
+            raise GitError("Bitmap does not match its pack: " + bitmapfile)
+        self.packindex = packindex
+        self.order = packindex.revindex()
+        self.packpos = array("I", bytes(4 * packindex.objnum))
+        for pos in range(len(self.order)):
+            self.packpos[self.order[pos]] = pos
+        off = 32
+        (self.commits, off) = ewahdecode(buf, off)
+        (self.trees, off) = ewahdecode(buf, off)
+        (self.blobs, off) = ewahdecode(buf, off)
+        (self.tags, off) = ewahdecode(buf, off)
+        self.bitmaps = {}
+        resolved = []
+        for i in range(entrynum):
+            (objpos, xoroff, flags) = unpack_from(">IBB", buf, off)
+            (bitmap, off) = ewahdecode(buf, off + 6)
+            if xoroff:
+                bitmap ^= resolved[i - xoroff]
+            resolved.append(bitmap)
+            self.bitmaps[packindex.objid(objpos)] = bitmap
+
+    def position(self, objid):
+        i = self.packindex.find(objid)
+        if i == None:
+            return None
+        return self.packpos[i]
+
+    def objid(self, pos):
+        return self.packindex.objid(self.order[pos])
+
+
+class GitReachabilityIndex:
+    def __init__(self, repo, usegitbitmap=True):
+        self.repo = repo
+        self.packbitmap = None
+        self.base = 0
+        self.numbers = {}
+        self.commitids = []
+        self.bitmaps = {}
+        self.parentmap = {}
+        self.mask = None
+        self.lock = threading.Lock()
+        if usegitbitmap:
+            for packfile in repo.packnames:
+                bitmapfile = packfile[:-5] + ".bitmap"
+                if os.path.isfile(bitmapfile):
+                    packindex = GitPackIndex(packfile[:-5] + ".idx")
+                    try:
+                        self.packbitmap = GitPackBitmap(bitmapfile, packindex)
+                    except GitError:
+                        packindex.close()
+                        continue
+                    self.base = packindex.objnum
+                    self.mask = self.packbitmap.commits
+                    self.bitmaps.update(self.packbitmap.bitmaps)
+                    break
+
+    def number(self, commitid):
+        if self.packbitmap:
+            pos = self.packbitmap.position(commitid)
+            if pos != None:
+                return pos
+        with self.lock:
+            if commitid not in self.numbers:
+                self.numbers[commitid] = self.base + len(self.commitids)
+                self.commitids.append(commitid)
+            return self.numbers[commitid]
+
+    def commitid(self, number):
+        if number < self.base:
+            return self.packbitmap.objid(number)
+        return self.commitids[number - self.base]
+
+    def resolve(self, ref):
+        commitid = self.repo.resolvecommit(ref)
+        if commitid == None:
+            raise GitError("Unknown commit: %s" % (ref.hex() if type(ref) == bytes else ref))
+        return commitid
+
+    def reach(self, commitid, memoize=False):
+        if commitid == None:
+            raise GitError("Unknown commit: None")
+        if commitid in self.bitmaps:
+            return self.bitmaps[commitid]
+        bitmap = 0
+        merged = False
+        seen = set()
+        stack = [commitid]
+        while stack:
+            c = stack.pop()
+            if c in seen:
+                continue
+            seen.add(c)
+            if c in self.bitmaps:
+                bitmap |= self.bitmaps[c]
+                merged = True
+                continue
+            bitmap |= 1 << self.number(c)
+            for p in self.parents(c):
+                if p not in seen:
+                    if merged and p not in self.bitmaps and bitmap >> self.number(p) & 1:
+                        continue
+                    stack.append(p)
+        if memoize:
+            self.bitmaps[commitid] = bitmap
+        return bitmap
+
+    def parents(self, commitid):
+        if commitid not in self.parentmap:
+            commit = self.repo.readobj(commitid)
+            if not isinstance(commit, GitCommitObject):
+                raise GitError("Unknown commit: %s" % commitid.hex())
+            self.parentmap[commitid] = tuple(p for p in (commit.parent, commit.mergefrom) if p)
+        return self.parentmap[commitid]
+
+    def commitbits(self, bitmap):
+        if self.mask != None:
+            bitmap &= self.mask | ~((1 << self.base) - 1)
+        return bitmap
+
+    def build(self, refs=None, interval=100):
+        if refs == None:
+            refs = list(self.repo.branches) + list(self.repo.tags)
+        tips = []
+        for ref in refs:
+            commitid = self.repo.resolvecommit(ref)
+            if commitid:
+                tips.append(commitid)
+        topo = []
+        seen = set()
+        for tip in tips:
+            stack = [(tip, False)]
+            while stack:
+                (c, done) = stack.pop()
+                if done:
+                    topo.append(c)
+                    continue
+                if c in seen:
+                    continue
+                seen.add(c)
+                stack.append((c, True))
+                if c in self.bitmaps:
+                    continue
+                for p in reversed(self.parents(c)):
+                    if p not in seen:
+                        stack.append((p, False))
+        tipset = set(tips)
+        for i in range(len(topo)):
+            if i % interval == interval - 1 or topo[i] in tipset:
+                self.reach(topo[i], True)
+
+    def save(self, path):
+        if self.packbitmap:
+            raise GitError("Indexes numbered by a pack bitmap cannot be saved")
+        bitsize = len(self.commitids)
+        out = [b'GTBM', pack(">II", bitsize, len(self.bitmaps))]
+        out += self.commitids
+        for commitid, bitmap in self.bitmaps.items():
+            out.append(commitid)
+            out.append(ewahencode(bitmap, bitsize))
+        open(path, "wb").write(b''.join(out))
+
+    def load(self, path):
+        buf = open(path, "rb").read()
+        if buf[0:4] != b'GTBM' or self.packbitmap:
+            raise GitError("Invalid reachability index: " + path)
+        (bitsize, entrynum) = unpack_from(">II", buf, 4)
+        off = 12
+        for i in range(bitsize):
+            self.number(buf[off:off + 20])
+            off += 20
+        for i in range(entrynum):
+            commitid = buf[off:off + 20]
+            (self.bitmaps[commitid], off) = ewahdecode(buf, off + 20)
+
+    def count(self, ref):
+        return popcount(self.commitbits(self.reach(self.resolve(ref))))
+
+    def contains(self, ref, commitid):
+        bitmap = self.reach(self.resolve(ref))
+        return bool(bitmap >> self.number(commitid) & 1)
+
+    def ahead_behind(self, ref, base):
+        bitmap1 = self.commitbits(self.reach(self.resolve(ref)))
+        bitmap2 = self.commitbits(self.reach(self.resolve(base)))
+        return (popcount(bitmap1 & ~bitmap2), popcount(bitmap2 & ~bitmap1))
+
+    def difference(self, ref, base):
+        bitmap1 = self.commitbits(self.reach(self.resolve(ref)))
+        bitmap2 = self.commitbits(self.reach(self.resolve(base)))
+        return [self.commitid(n) for n in iterbits(bitmap1 & ~bitmap2)]
+
+    def merge_bases(self, ref1, ref2):
+        commit1 = self.resolve(ref1)
+        commit2 = self.resolve(ref2)
+        bitmap2 = self.reach(commit2, True)
+        candidates = []
+        seen = set()
+        stack = [commit1]
+        while stack:
+            c = stack.pop()
+            if c in seen:
+                continue
+            seen.add(c)
+            if bitmap2 >> self.number(c) & 1:
+                candidates.append(c)
+            else:
+                stack += self.parents(c)
+        ret = []
+        for c in candidates:
+            n = self.number(c)
+            if not any(o != c and self.reach(o, True) >> n & 1 for o in candidates):
+                ret.append(c)
+        return ret
+
+    def all_merge_bases(self, pairs):
+        self.build({ref for pair in pairs for ref in pair})
+        return {(ref1, ref2): self.merge_bases(ref1, ref2) for (ref1, ref2) in pairs}
+
+    def fork_point(self, ref, bases):
+        commitid = self.resolve(ref)
+        bitmap = self.commitbits(self.reach(commitid, True))
+        best = None
+        for base in bases:
+            if base == ref:
+                continue
+            basecommit = self.resolve(base)
+            basebitmap = self.reach(basecommit, True)
+            if basebitmap >> self.number(commitid) & 1:
+                continue
+            basebitmap = self.commitbits(basebitmap)
+            ahead = popcount(bitmap & ~basebitmap)
+            behind = popcount(basebitmap & ~bitmap)
+            score = (ahead, behind)
+            if best == None or score < best[0]:
+                best = (score, base, basecommit, ahead, behind)
+        if best == None:
+            return None
+        mergebases = self.merge_bases(commitid, best[2])
+        return (best[1], mergebases[0] if mergebases else None, best[3], best[4])
+
+    def topology(self, refs=None, bases=None):
+        if refs == None:
+            refs = list(self.repo.branches)
+        if bases == None:
+            bases = refs
+        self.build(set(refs) | set(bases))
+        return {ref: self.fork_point(ref, bases) for ref in refs}
+
+
+class ObjectCache:
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item == None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.items or size > self.maxbytes:
+                return
+            self.items[key] = (value, size)
+            self.bytes += size
+            self.trim()
 
+    def resize(self, maxbytes):
+        with self.lock:
+            self.maxbytes = maxbytes
+            self.trim()
+
+    def trim(self):
+        while self.bytes > self.maxbytes and self.items:
+            (value, size) = self.items.popitem(last=False)[1]
+            self.bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+
+class PackFileCache:
+    def __init__(self, maxopen=None):
+        self.maxopen = maxopen
+        self.opened = 0
+        self.idle = {}
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+    def closeidle(self, count):
+        while count > 0 and self.lru:
+            (fd, path) = self.lru.popitem(last=False)
+            fds = self.idle[path]
+            fds.remove(fd)
+            if not fds:
+                del self.idle[path]
+            fd.close()
+            self.opened -= 1
+            count -= 1
+
+    def acquire(self, path):
+        with self.lock:
+            fds = self.idle.get(path)
+            if fds:
+                fd = fds.pop()
+                if not fds:
+                    del self.idle[path]
+                del self.lru[fd]
+                return fd
+            if self.maxopen != None:
+                self.closeidle(self.opened - self.maxopen + 1)
+            self.opened += 1
+        try:
+            return open(path, "rb")
+        except:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def release(self, path, fd):
+        with self.lock:
+            self.idle.setdefault(path, []).append(fd)
+            self.lru[fd] = path
+            if self.maxopen != None:
+                self.closeidle(self.opened - self.maxopen)
+
+    def closepaths(self, paths):
+        with self.lock:
+            for path in paths:
+                for fd in self.idle.pop(path, []):
+                    del self.lru[fd]
+                    fd.close()
+                    self.opened -= 1
+
+
+class GitMetrics:
     def __init__(self, repo):
+        self.repo = repo
+        self.objects = {}
+        self.bytesinflated = 0
+        self.deltadepth = {}
+        self.latency = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cachebase = self.cachecounters()
+        self.cachefinal = None
+
+    def cachecounters(self):
+        return {
+            "object": (self.repo.objcache.hits, self.repo.objcache.misses),
+            "delta": (self.repo.deltacache.hits, self.repo.deltacache.misses),
+        }
+
+    def stop(self):
+        self.cachefinal = self.cachecounters()
+
+    def countobj(self, ftype, source):
+        key = (ftype, source)
+        with self.lock:
+            self.objects[key] = self.objects.get(key, 0) + 1
+
+    def countdepth(self, depth):
+        with self.lock:
+            self.deltadepth[depth] = self.deltadepth.get(depth, 0) + 1
+
+    def countbytes(self, size):
+        with self.lock:
+            self.bytesinflated += size
+
+    def timecall(self, name, func, args, kwargs):
+        active = getattr(self.local, "active", None)
+        if active == None:
+            active = self.local.active = set()
+        if name in active:
+            return func(*args, **kwargs)
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            active.discard(name)
+            with self.lock:
+                stat = self.latency.get(name)
+                if stat == None:
+                    stat = self.latency[name] = [0, 0.0, 0.0]
+                stat[0] += 1
+                stat[1] += elapsed
+                stat[2] = max(stat[2], elapsed)
+
+    def merge(self, other):
+        with self.lock:
+            for key, count in other.objects.items():
+                self.objects[key] = self.objects.get(key, 0) + count
+            self.bytesinflated += other.bytesinflated
+            for depth, count in other.deltadepth.items():
+                self.deltadepth[depth] = self.deltadepth.get(depth, 0) + count
+            for name, (calls, total, longest) in other.latency.items():
+                stat = self.latency.setdefault(name, [0, 0.0, 0.0])
+                stat[0] += calls
+                stat[1] += total
+                stat[2] = max(stat[2], longest)
+
+    def snapshot(self):
+        objects = {}
+        for (ftype, source), count in self.objects.items():
+            objects.setdefault(ftype.name, {})[source] = count
+        current = self.cachefinal if self.cachefinal else self.cachecounters()
+        cache = {}
+        for name in current:
+            cache[name] = {
+                "hits": current[name][0] - self.cachebase[name][0],
+                "misses": current[name][1] - self.cachebase[name][1],
+            }
+        latency = {}
+        for name, (calls, total, longest) in self.latency.items():
+            latency[name] = {"calls": calls, "total": total, "mean": total / calls, "max": longest}
+        return {
+            "objects": objects,
+            "bytes_inflated": self.bytesinflated,
+            "delta_depth": dict(sorted(self.deltadepth.items())),
+            "cache": cache,
+            "latency": latency,
+        }
+
+
+TIMEDCALLS = []
+
+
+def timed(name):
+    def decorator(func):
+        TIMEDCALLS.append((func.__name__, name))
+        return func
+    return decorator
+
+
+def readvarint(buf, off):
+    c = buf[off]
+    val = c & 127
+    off += 1
+    while c & 128:
+        c = buf[off]
+        off += 1
+        val = ((val + 1) << 7) | (c & 127)
+    return (val, off)
+
+
+def hashblob(raw):
+    return sha1(b"blob %d\x00" % len(raw) + raw).digest()
+
+
+class GitIndex:
+    def __init__(self, indexfile):
+        self.indexfile = indexfile
+        self.mtime = os.stat(indexfile).st_mtime_ns
+        buf = open(indexfile, "rb").read()
+        if buf[0:4] != b'DIRC':
+            raise GitError("Invalid index file: " + indexfile)
+        (self.version, count) = unpack_from(">II", buf, 4)
+        if self.version not in (2, 3, 4):
+            raise GitError("Unsupported index version %d: %s" % (self.version, indexfile))
+        self.count = count
+        self.stats = array("I")
+        self.ids = bytearray()
+        self.flags = array("I")
+        self.paths = []
+        self.pathindex = None
+        self.untracked = None
+        self.fsmonitor = None
+        off = 12
+        prev = b''
+        for i in range(count):
+            self.stats.extend(unpack_from(">10I", buf, off))
+            self.ids += buf[off + 40:off + 60]
+            flags = unpack_from(">H", buf, off + 60)[0]
+            start = off + 62
+            if flags & 0x4000 and self.version >= 3:
+                flags |= unpack_from(">H", buf, start)[0] << 16
+                start += 2
+            if self.version == 4:
+                (strip, start) = readvarint(buf, start)
+                end = buf.index(b'\x00', start)
+                name = prev[:len(prev) - strip] + buf[start:end]
+                off = end + 1
+            else:
+                end = buf.index(b'\x00', start)
+                name = buf[start:end]
+                off += (start - off + len(name) + 8) & ~7
+            prev = name
+            self.flags.append(flags)
+            self.paths.append(name.decode("utf-8", "surrogateescape"))
+
+        while off + 8 <= len(buf) - 20:
+            (sig, size) = unpack_from(">4sI", buf, off)
+            data = buf[off + 8:off + 8 + size]
+            if sig == b'link':
+                raise GitError("Split index files are not supported: " + indexfile)
+            elif sig == b'UNTR':
+                self.untracked = self.parseuntracked(data)
+            elif sig == b'FSMN':
+                self.fsmonitor = self.parsefsmonitor(data)
+            off += 8 + size
+
+    def parseuntracked(self, data):
+        (identlen, off) = readvarint(data, 0)
+        ret = {"ident": data[off:off + identlen].decode("utf-8", "surrogateescape")}
+        off += identlen
+        ret["info_exclude_stat"] = unpack_from(">9I", data, off)
+        ret["excludes_file_stat"] = unpack_from(">9I", data, off + 36)
+        ret["dir_flags"] = unpack_from(">I", data, off + 72)[0]
+        ret["info_exclude_hash"] = data[off + 76:off + 96]
+        ret["excludes_file_hash"] = data[off + 96:off + 116]
+        off += 116
+        end = data.index(b'\x00', off)
+        ret["exclude_per_dir"] = data[off:end].decode()
+        (dirnum, off) = readvarint(data, end + 1)
+        dirs = []
+        ret["dirs"] = dirs
+        if dirnum == 0:
+            return ret
+        stack = [("", None)]
+        while stack:
+            (prefix, parent) = stack.pop()
+            (untrackednum, off) = readvarint(data, off)
+            (subnum, off) = readvarint(data, off)
+            end = data.index(b'\x00', off)
+            name = data[off:end].decode("utf-8", "surrogateescape")
+            off = end + 1
+            path = prefix + name + "/" if name else prefix
+            entry = {"path": path, "untracked": [], "subdirs": [], "valid": False, "stat": None, "hash": None}
+            for i in range(untrackednum):
+                end = data.index(b'\x00', off)
+                entry["untracked"].append(data[off:end].decode("utf-8", "surrogateescape"))
+                off = end + 1
+            if parent != None:
+                parent["subdirs"].append(path)
+            dirs.append(entry)
+            stack += [(path, entry)] * subnum
+        (valid, off) = ewahdecode(data, off)
+        (checkonly, off) = ewahdecode(data, off)
+        (hashvalid, off) = ewahdecode(data, off)
+        for i in iterbits(valid):
+            dirs[i]["valid"] = True
+            dirs[i]["stat"] = unpack_from(">9I", data, off)
+            off += 36
+        for i in iterbits(hashvalid):
+            dirs[i]["hash"] = data[off:off + 20]
+            off += 20
+        return ret
+
+    def parsefsmonitor(self, data):
+        version = unpack_from(">I", data, 0)[0]
+        if version == 1:
+            token = str(unpack_from(">Q", data, 4)[0])
+            off = 12
+        else:
+            end = data.index(b'\x00', 4)
+            token = data[4:end].decode()
+            off = end + 1
+        (dirty, off) = ewahdecode(data, off + 4)
+        return {"version": version, "token": token, "dirty": dirty}
+
+    def __len__(self):
+        return self.count
+
+    def stat(self, i):
+        return self.stats[i * 10:i * 10 + 10]
+
+    def objid(self, i):
+        return bytes(self.ids[i * 20:i * 20 + 20])
+
+    def mode(self, i):
+        return self.stats[i * 10 + 6]
+
+    def stage(self, i):
+        return self.flags[i] >> 12 & 3
+
+    def find(self, path):
+        if self.pathindex == None:
+            self.pathindex = {self.paths[i]: i for i in range(self.count) if not self.flags[i] & 0x3000}
+        return self.pathindex.get(path)
+
+
+class GitIgnore:
+    def __init__(self):
+        self.rules = []
+
+    def addfile(self, path, base=""):
+        try:
+            lines = open(path, "rb").read().decode("utf-8", "surrogateescape").splitlines()
+        except OSError:
+            return
+        for line in lines:
+            line = line.rstrip()
+            if line == "" or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dironly = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            line = line.lstrip("/")
+            self.rules.append((base, anchored, re.compile(self.translate(line)), negate, dironly))
+
+    def translate(self, pattern):
+        ret = []
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                ret.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+                ret.append("/.*")
+                i += 3
+            elif pattern[i] == "*":
+                ret.append("[^/]*")
+                i += 1
+            elif pattern[i] == "?":
+                ret.append("[^/]")
+                i += 1
+            elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+                end = pattern.index("]", i + 2 if pattern[i + 1:i + 2] in ("!", "]") else i + 1)
+                ret.append("[" + pattern[i + 1:end].replace("!", "^", 1 if pattern[i + 1] == "!" else 0) + "]")
+                i = end + 1
+            else:
+                ret.append(re.escape(pattern[i]))
+                i += 1
+        return "".join(ret) + "$"
+
+    def ignored(self, path, isdir):
+        ret = False
+        for base, anchored, regex, negate, dironly in self.rules:
+            if dironly and not isdir:
+                continue
+            if not path.startswith(base):
+                continue
+            rel = path[len(base):]
+            target = rel if anchored else rel.rsplit("/", 1)[-1]
+            if regex.match(target):
+                ret = not negate
+        return ret
+
+
+class GitStatus:
+    def __init__(self):
+        self.staged = []
+        self.unstaged = []
+        self.untracked = []
+        self.unmerged = []
+
+    def __str__(self):
+        ret = []
+        for diff in self.staged:
+            ret.append("staged    %s %s" % (diff.method, diff.filepath))
+        for diff in self.unstaged:
+            ret.append("unstaged  %s %s" % (diff.method, diff.filepath))
+        for path in self.unmerged:
+            ret.append("unmerged    %s" % path)
+        for path in self.untracked:
+            ret.append("untracked   %s" % path)
+        return "\n".join(ret)
+
+
+class GitRepo:
+
+    def __init__(self, repo, packcache=None, cachesize=64 << 20, deltacachesize=32 << 20, worktree=None):
         self.objs = {}
-        self.packfiles = []
+        self.midx = None
+        self.packnames = []
+        self.packcache = packcache if packcache else PackFileCache()
+        self.objcache = ObjectCache(cachesize)
+        self.deltacache = ObjectCache(deltacachesize)
         self.repo = repo
         self.branches = {}
         self.tags = {}
         self.header = None
+        self.reachindex = None
+        self.metrics = None
+        self.worktree = worktree
+        if worktree == None and os.path.basename(os.path.abspath(repo)) == ".git":
+            self.worktree = os.path.dirname(os.path.abspath(repo))
+        self.loosedirs = {}
         self.objstore = os.path.join(repo, "objects")
-        for objectfile in glob.glob(os.path.join(self.objstore, "??", "*")):
-            hashstr = objectfile[-41:-39] + objectfile[-38:]
-            hashstr = bytes.fromhex(hashstr)
-            self.objs[hashstr] = (0, -1)
-
-        packidx = 0
-        for idxfile in glob.glob(os.path.join(self.objstore, "pack", "*.idx")):
-            self.loadobjidx(idxfile, packidx)
+
+        packdir = os.path.join(self.objstore, "pack")
+        midxfile = os.path.join(packdir, "multi-pack-index")
+        if os.path.isfile(midxfile):
+            try:
+                self.midx = GitMultiPackIndex(midxfile)
+                for name in self.midx.packnames:
+                    self.packnames.append(os.path.join(packdir, name[:-4] + ".pack"))
+            except GitError:
+                self.midx = None
+
+        for idxfile in glob.glob(os.path.join(packdir, "*.idx")):
             packfile = idxfile[:-4] + ".pack"
-            self.packfiles.append(open(packfile, "rb"))
-            packidx += 1
+            if packfile in self.packnames:
+                continue
+            self.loadobjidx(idxfile, len(self.packnames))
+            self.packnames.append(packfile)
 
         self.loadrefs()
 
@@ -217,9 +1144,9 @@ class GitRepo:
     def loadobjidx(self, idxfile, packidx):
         buf = open(idxfile, "rb").read()
         if buf[0:4] != b'\xfftOc':
-            raise "Invalid idx file: " + idxfile
+            raise GitError("Invalid idx file: " + idxfile)
         if buf[4:8] != b'\x00\x00\x00\x02':
-            raise "Invalid idx file: " + idxfile
+            raise GitError("Invalid idx file: " + idxfile)
         objnum = unpack(">I", buf[1028:1032])[0]
         hasharray = 1032
         crcarray = hasharray + 20 * objnum
@@ -234,6 +1161,124 @@ class GitRepo:
             self.objs[hashstr] = (
              off, packidx)
 
+    @contextmanager
+    def packfile(self, idx):
+        path = self.packnames[idx]
+        fd = self.packcache.acquire(path)
+        try:
+            yield fd
+        finally:
+            self.packcache.release(path, fd)
+
+    def enable_metrics(self):
+        if self.metrics == None:
+            self.metrics = GitMetrics(self)
+            self.settimers(True)
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+        self.settimers(False)
+
+    def settimers(self, enabled):
+        for attr, name in TIMEDCALLS:
+            if not enabled:
+                self.__dict__.pop(attr, None)
+            elif attr not in self.__dict__:
+                self.__dict__[attr] = partial(self.timecall, name, getattr(type(self), attr))
+
+    def timecall(self, name, func, *args, **kwargs):
+        if self.metrics == None:
+            return func(self, *args, **kwargs)
+        return self.metrics.timecall(name, func, (self,) + args, kwargs)
+
+    @contextmanager
+    def profile(self):
+        previous = self.metrics
+        metrics = GitMetrics(self)
+        self.metrics = metrics
+        self.settimers(True)
+        try:
+            yield metrics
+        finally:
+            metrics.stop()
+            self.metrics = previous
+            if previous:
+                previous.merge(metrics)
+            else:
+                self.settimers(False)
+
+    def close(self):
+        self.packcache.closepaths(set(self.packnames))
+        if self.midx:
+            self.midx.close()
+            self.midx = None
+        self.objcache.clear()
+        self.deltacache.clear()
+
+    def iterpackobjs(self):
+        yield from self.objs.items()
+        if self.midx:
+            yield from self.midx
+
+    def loosepath(self, objid):
+        hexstr = objid.hex()
+        return os.path.join(self.objstore, hexstr[0:2], hexstr[2:])
+
+    def findobj(self, objid):
+        if not objid:
+            return None
+        if objid in self.objs:
+            return self.objs[objid]
+        if self.midx:
+            loc = self.midx.find(objid)
+            if loc:
+                return loc
+        if os.path.isfile(self.loosepath(objid)):
+            return (0, -1)
+        return None
+
+    def listloosedir(self, fanout):
+        if fanout not in self.loosedirs:
+            objs = set()
+            try:
+                names = os.listdir(os.path.join(self.objstore, fanout))
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                if len(name) == 38:
+                    try:
+                        objs.add(bytes.fromhex(fanout + name))
+                    except ValueError:
+                        pass
+            self.loosedirs[fanout] = objs
+        return self.loosedirs[fanout]
+
+    def iterlooseobjs(self):
+        for fanout in sorted(os.listdir(self.objstore)):
+            if len(fanout) == 2 and os.path.isdir(os.path.join(self.objstore, fanout)):
+                yield from self.listloosedir(fanout)
+
+    def findobjid(self, prefix):
+        prefix = prefix.lower()
+        if len(prefix) == 40:
+            objid = bytes.fromhex(prefix)
+            return objid if self.findobj(objid) else None
+        if len(prefix) < 4:
+            return None
+        found = set()
+        for objid in self.objs:
+            if objid.hex().startswith(prefix):
+                found.add(objid)
+        if self.midx:
+            found.update(self.midx.findprefix(prefix))
+        for objid in self.listloosedir(prefix[0:2]):
+            if objid.hex().startswith(prefix):
+                found.add(objid)
+        if len(found) == 1:
+            return found.pop()
+        return None
+
     def readnumber(self, fd):
         c = fd.read(1)[0]
         fshift = 7
@@ -259,12 +1304,16 @@ class GitRepo:
         ret = []
         d = zlib.decompressobj()
         size_remain = original_size
-        while size_remain>0:
+        while size_remain>0 and not d.eof:
             buf = fd.read(1024)
+            if buf == b'':
+                break
             outstr = d.decompress(buf)
             size_remain -= len(outstr)
             ret.append(outstr)
 
+        if self.metrics:
+            self.metrics.countbytes(original_size - size_remain)
         return (b'').join(ret)
 
     def decompressdelta(self, base, delta):
@@ -303,7 +1352,13 @@ class GitRepo:
 
         return (b'').join(ret)
 
-    def readpackerobj(self, fd, off):
+    def readpackerobj(self, fd, off, idx=None):
+        (ftype, objraw, depth) = self.readpackerdepth(fd, off, idx)
+        if self.metrics:
+            self.metrics.countdepth(depth)
+        return (ftype, objraw)
+
+    def readpackerdepth(self, fd, off, idx=None):
         fd.seek(off)
         ftype, flen = self.readnumber2(fd)
         ftype = GitObjectType(ftype)
@@ -315,67 +1370,193 @@ class GitRepo:
                 ofs = (ofs << 7) + 128 + (c & 127)
 
             deltaraw = self.decompress(fd, flen)
-            (base_type, baseraw) = self.readpackerobj(fd, off - ofs)
-            return (base_type, self.decompressdelta(baseraw, deltaraw))
+            base = self.deltacache.get((idx, off - ofs)) if idx != None else None
+            if base == None:
+                base = self.readpackerdepth(fd, off - ofs, idx)
+                if idx != None:
+                    self.deltacache.put((idx, off - ofs), base, len(base[1]))
+            (base_type, baseraw, basedepth) = base
+            return (base_type, self.decompressdelta(baseraw, deltaraw), basedepth + 1)
         if ftype == GitObjectType.ref_delta:
             ref = fd.read(20)
             deltaraw = self.decompress(fd, flen)
-            baseobject = self.readobj(ref)
-            base_type = baseobject.type
-            return (base_type, self.decompressdelta(baseobject.raw, deltaraw))
-        return (ftype, self.decompress(fd, flen))
+            (base_type, baseraw, basedepth) = self.readobjdepth(ref)
+            return (base_type, self.decompressdelta(baseraw, deltaraw), basedepth + 1)
+        return (ftype, self.decompress(fd, flen), 0)
+
+    def readobjdepth(self, objid):
+        loc = self.findobj(objid)
+        if loc == None or loc[1] == -1:
+            (ftype, objraw) = self.readobjraw(objid)
+            return (ftype, objraw, 0)
+        (off, idx) = loc
+        with self.packfile(idx) as fd:
+            return self.readpackerdepth(fd, off, idx)
+
+    def readobjraw(self, objid):
+        loc = self.findobj(objid)
+        if loc == None:
+            return (None, None)
+        (off, idx) = loc
+        if idx == -1:
+            objraw = open(self.loosepath(objid), "rb").read()
+            objraw = zlib.decompress(objraw)
+            hdrlen = objraw.index(b'\x00')
+            headers = objraw[:hdrlen].decode().split(" ")
+            ftype = headers[0]
+            flen = int(headers[1])
+            objraw = objraw[hdrlen + 1:hdrlen + 1 + flen]
+            ftype = GitObjectType[ftype]
+            if self.metrics:
+                self.metrics.countbytes(hdrlen + 1 + flen)
+                self.metrics.countobj(ftype, "loose")
+        else:
+            with self.packfile(idx) as fd:
+                (ftype, objraw) = self.readpackerobj(fd, off, idx)
+            if self.metrics:
+                self.metrics.countobj(ftype, "pack")
+        return (ftype, objraw)
+
+    def readobjheader(self, objid):
+        loc = self.findobj(objid)
+        if loc == None:
+            return (None, None)
+        (off, idx) = loc
+        if idx == -1:
+            fd = open(self.loosepath(objid), "rb")
+            d = zlib.decompressobj()
+            header = b''
+            while b'\x00' not in header:
+                buf = fd.read(64)
+                if buf == b'':
+                    break
+                header += d.decompress(buf, 64)
+            fd.close()
+            (ftype, flen) = header.split(b'\x00')[0].decode().split(" ")
+            return (GitObjectType[ftype], int(flen))
+        with self.packfile(idx) as fd:
+            fd.seek(off)
+            ftype, flen = self.readnumber2(fd)
+            ftype = GitObjectType(ftype)
+            if ftype == GitObjectType.ofs_delta:
+                c = fd.read(1)[0]
+                while c & 128:
+                    c = fd.read(1)[0]
+            elif ftype == GitObjectType.ref_delta:
+                fd.read(20)
+            else:
+                return (ftype, flen)
+            d = zlib.decompressobj()
+            delta = b''
+            while len(delta) < 20 and not d.eof:
+                buf = fd.read(64)
+                if buf == b'':
+                    break
+                delta += d.decompress(buf, 20 - len(delta))
+        deltafd = BytesIO(delta)
+        self.readnumber(deltafd)
+        flen = self.readnumber(deltafd)
+        return (self.getobjtyperapid(objid), flen)
 
-    @lru_cache(maxsize=1000)
+    @timed("readobj")
     def readobj(self, objid):
-        if objid in self.objs:
-            (off, idx) = self.objs[objid]
-            if idx == -1:
-                hexstr = objid.hex()
-                objfile = os.path.join(self.objstore, hexstr[0:2], hexstr[2:])
-                objraw = open(objfile, "rb").read()
-                objraw = zlib.decompress(objraw)
-                hdrlen = objraw.index(b'\x00')
-                headers = objraw[:hdrlen].decode().split(" ")
-                ftype = headers[0]
-                flen = int(headers[1])
-                objraw = objraw[hdrlen + 1:hdrlen + 1 + flen]
-                ftype = GitObjectType[ftype]
+        obj = self.objcache.get(objid)
+        if obj != None:
+            return obj
+        (ftype, objraw) = self.readobjraw(objid)
+        if ftype == GitObjectType.commit:
+            obj = GitCommitObject(objid, objraw)
+        elif ftype == GitObjectType.tree:
+            obj = GitTreeObject(objid, objraw)
+        elif ftype == GitObjectType.blob:
+            obj = GitBlobObject(objid, objraw)
+        elif ftype == GitObjectType.tag:
+            obj = GitTagObject(objid, objraw)
+        else:
+            return None
+        self.objcache.put(objid, obj, len(objraw) + 256)
+        return obj
+
+    def readref(self, refname):
+        reffile = os.path.join(self.repo, *refname.split("/"))
+        if os.path.isfile(reffile):
+            return bytes.fromhex(open(reffile).readline().strip())
+        packedrefs = os.path.join(self.repo, "packed-refs")
+        if os.path.isfile(packedrefs):
+            for line in open(packedrefs):
+                m = re.match("([0-9a-f]{40}) (.+)", line.strip())
+                if m and m[2] == refname:
+                    return bytes.fromhex(m[1])
+        return None
+
+    def resolveobj(self, name):
+        if ":" in name:
+            (rev, path) = name.split(":", 1)
+            commitid = self.resolvecommit(rev)
+            if commitid == None:
+                return None
+            tree = self.readobj(commitid).tree
+            return self.find_fileobj_id(tree, path.strip("/")) if path.strip("/") else tree
+        if name in self.branches:
+            return self.branches[name]
+        if name in self.tags:
+            return self.tags[name]
+        if name == "HEAD":
+            head = open(os.path.join(self.repo, "HEAD")).readline().strip()
+            if head.startswith("ref: "):
+                return self.readref(head[5:])
+            name = head
+        try:
+            return self.findobjid(name)
+        except ValueError:
+            return None
+
+    def resolvecommit(self, ref):
+        commitid = ref if type(ref) == bytes else self.resolveobj(ref)
+        while commitid:
+            obj = self.readobj(commitid)
+            if isinstance(obj, GitTagObject):
+                commitid = obj.object
+            elif isinstance(obj, GitCommitObject):
+                return commitid
             else:
-                fd = self.packfiles[idx]
-                (ftype, objraw) = self.readpackerobj(fd, off)
-            if ftype == GitObjectType.commit:
-                return GitCommitObject(objid, objraw)
-            if ftype == GitObjectType.tree:
-                return GitTreeObject(objid, objraw)
-            if ftype == GitObjectType.blob:
-                return GitBlobObject(objid, objraw)
-            if ftype == GitObjectType.tag:
-                return GitTagObject(objid, objraw)
+                return None
+        return None
 
-    def list_commits(self, branch, parent=None):
-        parentset = {}
+    def getreachability(self, build=False):
+        if self.reachindex == None:
+            self.reachindex = GitReachabilityIndex(self)
+            if build:
+                self.reachindex.build()
+        return self.reachindex
+
+    def iter_commits(self, branch, parent=None):
+        reachindex = None
         if parent:
-            commits = self.list_commits(parent)
-            parentset = {c.objid for c in commits}
-        ret = []
+            parentid = self.resolvecommit(parent)
+            if parentid:
+                reachindex = self.getreachability()
+                parentbits = reachindex.reach(parentid, True)
         if branch in self.branches:
-            commitid = self.branches[branch]
+            commitid = self.resolvecommit(self.branches[branch])
         elif branch in self.tags:
-            commitid = self.tags[branch]
+            commitid = self.resolvecommit(self.tags[branch])
         else:
-            return ret
-        
+            return
+
+        seq = 0
         while commitid:
             commitobj = self.readobj(commitid)
             commitid = commitobj.parent
-            ret.append(commitobj)
-            if commitid in parentset:
+            commitobj.seq = seq
+            seq += 1
+            yield commitobj
+            if reachindex and commitid and parentbits >> reachindex.number(commitid) & 1:
                 break
 
-        for i in range(len(ret)):
-            ret[i].seq = i
-
-        return ret
+    @timed("list_commits")
+    def list_commits(self, branch, parent=None):
+        return list(self.iter_commits(branch, parent))
 
     def find_fileobj_id(self, roottreeid, path):
         treeid = roottreeid
@@ -390,9 +1571,276 @@ class GitRepo:
 
         return treeid
 
-    def list_file_history(self, commitid, filepath):
+    def walk_tree(self, treeid, pathspec=None, prefix=""):
+        if type(pathspec) == str:
+            pathspec = [pathspec]
+        stack = [(iter(self.readobj(treeid).children.items()), prefix)]
+        while stack:
+            (children, prefix) = stack[-1]
+            for name, (mode, objid) in children:
+                path = prefix + name
+                if mode == 16384:
+                    if pathspec == None or matchpathspec(path, pathspec, True):
+                        stack.append((iter(self.readobj(objid).children.items()), path + "/"))
+                        break
+                elif pathspec == None or matchpathspec(path, pathspec):
+                    yield (path, mode, objid)
+            else:
+                stack.pop()
+
+    def export(self, commit, dest, pathspec=None, threads=8):
+        commitid = self.resolvecommit(commit)
+        if commitid == None:
+            raise GitError("Unknown commit: %s" % commit)
+        commitobj = self.readobj(commitid)
+        committer = re.search(rb"^committer .*> (\d+) [+-]\d+$", commitobj.raw, re.M)
+        mtime = int(committer[1]) if committer else commitobj.createtime
+        entries = []
+        for path, mode, objid in self.walk_tree(commitobj.tree, pathspec):
+            loc = self.findobj(objid) if mode != 0o160000 else None
+            if loc and loc[1] >= 0:
+                entries.append(((loc[1], loc[0]), path, mode, objid))
+            else:
+                entries.append(((len(self.packnames), 0), path, mode, objid))
+        entries.sort(key=lambda e: e[0])
+
+        def inflate(entry):
+            if entry[2] == 0o160000:
+                return None
+            (ftype, raw) = self.readobjraw(entry[3])
+            if ftype == None:
+                raise GitError("Missing object %s for %s" % (entry[3].hex(), entry[1]))
+            return raw
+
+        istar = isinstance(dest, tarfile.TarFile)
+        if not istar:
+            os.makedirs(dest, exist_ok=True)
+        executor = ThreadPoolExecutor(max_workers=threads)
+        pending = []
+        try:
+            for i in range(len(entries) + 1):
+                if i < len(entries):
+                    pending.append((entries[i], executor.submit(inflate, entries[i])))
+                    if len(pending) < threads * 4:
+                        continue
+                while pending and (i == len(entries) or len(pending) >= threads * 4):
+                    (entry, future) = pending.pop(0)
+                    self.exportfile(dest, istar, entry[1], entry[2], future.result(), mtime)
+        finally:
+            for entry, future in pending:
+                future.cancel()
+            executor.shutdown()
+        return len(entries)
+
+    def exportfile(self, dest, istar, path, mode, raw, mtime):
+        if istar:
+            info = tarfile.TarInfo(path)
+            info.mtime = mtime or 0
+            if mode == 0o120000:
+                info.type = tarfile.SYMTYPE
+                info.linkname = raw.decode()
+                dest.addfile(info)
+            elif mode == 0o160000:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                dest.addfile(info)
+            else:
+                info.size = len(raw)
+                info.mode = 0o755 if mode & 0o111 else 0o644
+                dest.addfile(info, BytesIO(raw))
+            return
+        filepath = os.path.join(dest, *path.split("/"))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if mode == 0o160000:
+            os.makedirs(filepath, exist_ok=True)
+        elif mode == 0o120000:
+            if os.path.lexists(filepath):
+                os.remove(filepath)
+            os.symlink(raw.decode(), filepath)
+        else:
+            with open(filepath, "wb") as fd:
+                fd.write(raw)
+            if mode & 0o111:
+                os.chmod(filepath, 0o755)
+
+    def readindex(self):
+        return GitIndex(os.path.join(self.repo, "index"))
+
+    def hashworktreefile(self, path, mode):
+        fullpath = os.path.join(self.worktree, *path.split("/"))
+        try:
+            if mode == 0o120000:
+                return hashblob(os.fsencode(os.readlink(fullpath)))
+            with open(fullpath, "rb") as fd:
+                return hashblob(fd.read())
+        except OSError:
+            return None
+
+    def status(self, untracked=True, threads=8):
+        if self.worktree == None:
+            raise GitError("Repository has no working tree: " + self.repo)
+        index = self.readindex()
+        ret = GitStatus()
+
+        head = {}
+        headid = self.resolveobj("HEAD")
+        if headid:
+            for path, mode, objid in self.walk_tree(self.readobj(headid).tree):
+                head[path] = (mode, objid)
+        indexed = set()
+        for i in range(len(index)):
+            path = index.paths[i]
+            if index.stage(i):
+                if path not in indexed:
+                    ret.unmerged.append(path)
+                indexed.add(path)
+                continue
+            indexed.add(path)
+            objid = index.objid(i)
+            if index.flags[i] & 0x20000000:
+                if path in head:
+                    ret.staged.append(DiffObject(None, path, "-", head[path][1], None))
+                continue
+            if path not in head:
+                ret.staged.append(DiffObject(None, path, "+", None, objid))
+            elif head[path][1] != objid or head[path][0] != index.mode(i):
+                ret.staged.append(DiffObject(None, path, "*", head[path][1], objid))
+        for path in head:
+            if path not in indexed:
+                ret.staged.append(DiffObject(None, path, "-", head[path][1], None))
+
+        tohash = []
+        for i in range(len(index)):
+            if index.stage(i) or index.flags[i] & 0x8000 or index.flags[i] & 0x40000000:
+                continue
+            path = index.paths[i]
+            mode = index.mode(i)
+            fullpath = os.path.join(self.worktree, *path.split("/"))
+            try:
+                st = os.lstat(fullpath)
+            except OSError:
+                ret.unstaged.append(DiffObject(None, path, "-", index.objid(i), None))
+                continue
+            if index.flags[i] & 0x20000000:
+                ret.unstaged.append(DiffObject(None, path, "+", None, self.hashworktreefile(path, mode)))
+                continue
+            if mode == 0o160000:
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                wtmode = 0o120000
+            elif stat.S_ISREG(st.st_mode):
+                wtmode = 0o100755 if st.st_mode & 0o100 else 0o100644
+            else:
+                ret.unstaged.append(DiffObject(None, path, "-", index.objid(i), None))
+                continue
+            if wtmode != mode:
+                ret.unstaged.append(DiffObject(None, path, "*", index.objid(i), None))
+                continue
+            s = index.stat(i)
+            mtime = st.st_mtime_ns
+            if (s[2] == (mtime // 1000000000) & 0xFFFFFFFF and s[3] == mtime % 1000000000 and
+                    s[9] == st.st_size & 0xFFFFFFFF and s[5] == st.st_ino & 0xFFFFFFFF and
+                    s[2] * 1000000000 + s[3] < index.mtime):
+                continue
+            tohash.append(i)
+
+        if tohash:
+            executor = ThreadPoolExecutor(max_workers=threads)
+            try:
+                hashes = executor.map(lambda i: self.hashworktreefile(index.paths[i], index.mode(i)), tohash)
+                for i, objid in zip(tohash, hashes):
+                    if objid != index.objid(i):
+                        ret.unstaged.append(DiffObject(None, index.paths[i], "*", index.objid(i), objid))
+            finally:
+                executor.shutdown()
+        ret.unstaged.sort(key=lambda d: d.filepath)
+
+        if untracked:
+            ret.untracked = self.listuntracked(index)
+        return ret
+
+    def listuntracked(self, index):
+        tracked = set(index.paths)
+        trackeddirs = set()
+        for path in index.paths:
+            while "/" in path:
+                path = path.rsplit("/", 1)[0]
+                if path + "/" in trackeddirs:
+                    break
+                trackeddirs.add(path + "/")
+        ignore = GitIgnore()
+        ignore.addfile(os.path.join(self.repo, "info", "exclude"))
+        cache = {}
+        uc = index.untracked
+        if uc and uc["dirs"] and uc["ident"].startswith("Location %s," % os.path.abspath(self.worktree)):
+            try:
+                st = os.stat(os.path.join(self.repo, "info", "exclude"))
+                samestat = tuple(uc["info_exclude_stat"][2:4]) == (int(st.st_mtime) & 0xFFFFFFFF, st.st_mtime_ns % 1000000000)
+            except OSError:
+                samestat = not any(uc["info_exclude_stat"])
+            if samestat:
+                cache = {d["path"]: d for d in uc["dirs"] if d["valid"]}
+
+        ret = []
+        stack = [""]
+        seen = set()
+        while stack:
+            prefix = stack.pop()
+            if prefix in seen:
+                continue
+            seen.add(prefix)
+            folder = os.path.join(self.worktree, *prefix.split("/")) if prefix else self.worktree
+            ignorefile = os.path.join(folder, ".gitignore")
+            ignore.addfile(ignorefile, prefix)
+            cached = cache.get(prefix)
+            if cached:
+                try:
+                    st = os.stat(folder)
+                    ighash = hashblob(open(ignorefile, "rb").read()) if os.path.isfile(ignorefile) else None
+                except OSError:
+                    st = None
+                if st and cached["stat"][2:4] == (int(st.st_mtime) & 0xFFFFFFFF, st.st_mtime_ns % 1000000000) and cached["hash"] == ighash:
+                    ret += [prefix + name for name in cached["untracked"]]
+                    subdirs = [d for d in trackeddirs if d != prefix and d.startswith(prefix) and "/" not in d[len(prefix):-1]]
+                    stack += sorted(subdirs, reverse=True)
+                    continue
+            try:
+                entries = sorted(os.scandir(folder), key=lambda e: e.name, reverse=True)
+            except OSError:
+                continue
+            for entry in entries:
+                path = prefix + entry.name
+                if entry.name == ".git":
+                    continue
+                isdir = entry.is_dir(follow_symlinks=False)
+                if isdir:
+                    if path + "/" in trackeddirs:
+                        stack.append(path + "/")
+                    elif path not in tracked and not ignore.ignored(path, True) and self.hasuntracked(entry.path, path + "/", ignore):
+                        ret.append(path + "/")
+                elif path not in tracked and not ignore.ignored(path, False):
+                    ret.append(path)
+        return sorted(ret)
+
+    def hasuntracked(self, folder, prefix, ignore):
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            return False
+        for entry in entries:
+            isdir = entry.is_dir(follow_symlinks=False)
+            if ignore.ignored(prefix + entry.name, isdir):
+                continue
+            if not isdir or self.hasuntracked(entry.path, prefix + entry.name + "/", ignore):
+                return True
+        return False
+
+    @timed("list_file_history")
+    def list_file_history(self, commitid, filepath, cancel=None, progress=None):
+        ret = []
         revs = []
         while commitid:
+            checkcancel(cancel)
             commit = self.readobj(commitid)
             if not commit:
                 break
@@ -406,14 +1854,18 @@ class GitRepo:
                     revs[-1][0] = commit
                 else:
                     revs.append([commit, fileid])
+                    ret.append(DiffObject(revs[-2][0].objid, filepath, "*", revs[-1][1], revs[-2][1]))
+                    if progress:
+                        progress(ret[-1])
                 commitid = commit.parent
 
-        ret = [DiffObject(revs[i][0].objid, filepath, "*", revs[i + 1][1], revs[i][1]) for i in range(len(revs) - 1)]
         ret.append(DiffObject(revs[-1][0].objid, filepath, "+", None, revs[-1][1]))
+        if progress:
+            progress(ret[-1])
         return ret
 
-    def compare_trees(self, oldtreeid, newtreeid):
-        diff = []
+    def iter_tree_diff(self, oldtreeid, newtreeid, prefix="", cancel=None):
+        checkcancel(cancel)
         if oldtreeid:
             tree1 = self.readobj(oldtreeid).children
             tree1folders = set([f for f in tree1.keys() if tree1[f][0] == 16384])
@@ -430,62 +1882,55 @@ class GitRepo:
             tree2files = set()
         for filename in tree1files & tree2files:
             if tree1[filename][1] != tree2[filename][1]:
-                diff.append(DiffObject(0, filename, "*", tree1[filename][1], tree2[filename][1]))
+                yield DiffObject(0, prefix + filename, "*", tree1[filename][1], tree2[filename][1])
 
         for filename in tree1files - tree2files:
-            diff.append(DiffObject(0, filename, "-", tree1[filename][1], None))
+            yield DiffObject(0, prefix + filename, "-", tree1[filename][1], None)
 
         for filename in tree2files - tree1files:
-            diff.append(DiffObject(0, filename, "+", None, tree2[filename][1]))
+            yield DiffObject(0, prefix + filename, "+", None, tree2[filename][1])
 
         for filename in tree1folders & tree2folders:
             if tree1[filename][1] != tree2[filename][1]:
-                subdiff = self.compare_trees(tree1[filename][1], tree2[filename][1])
-                for e in subdiff:
-                    e.filepath = filename + "/" + e.filepath
-                    diff.append(e)
+                yield from self.iter_tree_diff(tree1[filename][1], tree2[filename][1], prefix + filename + "/", cancel)
 
         for filename in tree1folders - tree2folders:
-            subdiff = self.compare_trees(tree1[filename][1], None)
-            for e in subdiff:
-                e.filepath = filename + "/" + e.filepath
-                diff.append(e)
+            yield from self.iter_tree_diff(tree1[filename][1], None, prefix + filename + "/", cancel)
 
         for filename in tree2folders - tree1folders:
-            subdiff = self.compare_trees(None, tree2[filename][1])
-            for e in subdiff:
-                e.filepath = filename + "/" + e.filepath
-                diff.append(e)
-        return diff
+            yield from self.iter_tree_diff(None, tree2[filename][1], prefix + filename + "/", cancel)
+
+    @timed("compare_trees")
+    def compare_trees(self, oldtreeid, newtreeid, cancel=None, progress=None, commitid=0):
+        diffs = []
+        for diff in self.iter_tree_diff(oldtreeid, newtreeid, "", cancel):
+            diff.commitid = commitid
+            diffs.append(diff)
+            if progress:
+                progress(diff)
+        return diffs
 
-    def compare_commits(self, oldcommitid, newcommitid):
+    def compare_commits(self, oldcommitid, newcommitid, cancel=None, progress=None):
         oldtree = self.readobj(oldcommitid).tree if oldcommitid else None
         newtree = self.readobj(newcommitid).tree if newcommitid else None
-        diffs = self.compare_trees(oldtree, newtree)
-        for diff in diffs:
-            diff.commitid = newcommitid
-
+        diffs = self.compare_trees(oldtree, newtree, cancel, progress, newcommitid)
         diffs = sorted(diffs, key=(lambda x: x.filepath))
         return diffs
 
-    def compare_commit_with_prev(self, commitid):
+    def compare_commit_with_prev(self, commitid, cancel=None, progress=None):
         commitobj = self.readobj(commitid)
         newtree = commitobj.tree
         oldtree = self.readobj(commitobj.parent).tree if commitobj.parent else None
-        diffs = self.compare_trees(oldtree, newtree)
-        for diff in diffs:
-            diff.commitid = commitid
-
+        diffs = self.compare_trees(oldtree, newtree, cancel, progress, commitid)
         diffs = sorted(diffs, key=(lambda x: x.filepath))
         return diffs
 
     def getobjtyperapid(self, objid, packfd=None, packoff=None):
-        if objid in self.objs:
-            (off, idx) = self.objs[objid]
+        loc = self.findobj(objid)
+        if loc:
+            (off, idx) = loc
             if idx == -1:
-                hexstr = objid.hex()
-                objfile = os.path.join(self.objstore, hexstr[0:2], hexstr[2:])
-                fd = open(objfile, "rb")
+                fd = open(self.loosepath(objid), "rb")
                 headerline = self.decompress(fd, 8)
                 fd.close()
                 if headerline.startswith(b"commit"):
@@ -501,7 +1946,8 @@ class GitRepo:
                     fd = packfd
                     off = packoff
                 else:
-                    fd = self.packfiles[idx]
+                    with self.packfile(idx) as fd:
+                        return self.getobjtyperapid(objid, fd, off)
                 fd.seek(off)
                 ftype, flen = self.readnumber2(fd)
                 ftype = GitObjectType(ftype)
@@ -518,27 +1964,431 @@ class GitRepo:
                 else:
                     return ftype
 
-    def itercommitobjs(self):
-        for i in range(0, len(self.packfiles)):
-            offs = [(v[0], k) for k,v in self.objs.items() if v[1]==i]
-            offs = sorted(offs)
-            fd = self.packfiles[i]
-            for off, objid in offs:
-                ftype = self.getobjtyperapid(objid)
-                if ftype == GitObjectType.commit:
-                    yield self.readobj(objid)
-
-        for objid in [k for k,v in self.objs.items() if v[1]==-1]:
-            hexstr = objid.hex()
-            objfile = os.path.join(self.objstore, hexstr[0:2], hexstr[2:])
-            fd = open(objfile, "rb")
+    def readpackheader(self, buf, off):
+        c = buf[off]
+        ftype = c >> 4 & 7
+        flen = c & 15
+        fshift = 4
+        off += 1
+        while c & 128:
+            c = buf[off]
+            flen = flen + ((c & 127) << fshift)
+            fshift += 7
+            off += 1
+        base = None
+        if ftype == GitObjectType.ofs_delta:
+            c = buf[off]
+            ofs = c & 127
+            off += 1
+            while c & 128:
+                c = buf[off]
+                ofs = (ofs << 7) + 128 + (c & 127)
+                off += 1
+            base = ofs
+        elif ftype == GitObjectType.ref_delta:
+            base = buf[off:off + 20]
+            off += 20
+        return (ftype, flen, base, off)
+
+    def scanpack(self, packidx, types=None, cachesize=64 << 20):
+        packfile = self.packnames[packidx]
+        idx = GitPackIndex(packfile[:-5] + ".idx")
+        fd = open(packfile, "rb")
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            order = idx.revindex()
+            offs = [idx.offset(i) for i in order]
+            offs.append(len(buf) - 20)
+            headers = []
+            baserefs = {}
+            for n in range(len(order)):
+                (ftype, flen, base, dataoff) = self.readpackheader(buf, offs[n])
+                if ftype == GitObjectType.ofs_delta:
+                    base = offs[n] - base
+                elif ftype == GitObjectType.ref_delta:
+                    i = idx.find(base)
+                    base = idx.offset(i) if i != None else base
+                if base != None:
+                    baserefs[base] = baserefs.get(base, 0) + 1
+                headers.append((ftype, base, dataoff))
+
+            offtypes = {}
+            cache = {}
+            cachebytes = 0
+            for n in range(len(order)):
+                off = offs[n]
+                (ftype, base, dataoff) = headers[n]
+                if base == None:
+                    objtype = GitObjectType(ftype)
+                elif base in offtypes:
+                    objtype = offtypes[base]
+                elif type(base) == bytes:
+                    objtype = self.getobjtyperapid(base)
+                else:
+                    objtype = self.getobjtyperapid(idx.objid(order[n]))
+                offtypes[off] = objtype
+                if types and objtype not in types:
+                    continue
+                data = zlib.decompress(buf[dataoff:offs[n + 1]])
+                if self.metrics:
+                    self.metrics.countbytes(len(data))
+                    self.metrics.countobj(objtype, "pack")
+                if base != None:
+                    if base in cache:
+                        baseraw = cache[base]
+                        baserefs[base] -= 1
+                        if baserefs[base] == 0:
+                            del cache[base]
+                            cachebytes -= len(baseraw)
+                    elif type(base) == bytes:
+                        baseraw = self.readobj(base).raw
+                    else:
+                        with self.packfile(packidx) as packfd:
+                            baseraw = self.readpackerobj(packfd, base, packidx)[1]
+                    data = self.decompressdelta(baseraw, data)
+                if off in baserefs:
+                    cache[off] = data
+                    cachebytes += len(data)
+                    while cachebytes > cachesize and cache:
+                        evicted = next(iter(cache))
+                        cachebytes -= len(cache.pop(evicted))
+                yield (idx.objid(order[n]), objtype, data)
+        finally:
+            buf.close()
+            fd.close()
+            idx.close()
+
+    def verify(self, full=False, workers=None, chunksize=20000, progress=None):
+        errors = []
+        tasks = []
+        total = 0
+        if self.midx:
+            tasks.append((verifytrailer, (os.path.join(self.objstore, "pack", "multi-pack-index"),)))
+        for packidx in range(len(self.packnames)):
+            packfile = self.packnames[packidx]
+            idxfile = packfile[:-5] + ".idx"
+            try:
+                idx = GitPackIndex(idxfile)
+            except (GitError, OSError) as e:
+                errors.append("%s: %s" % (idxfile, e))
+                continue
+            try:
+                packsize = os.path.getsize(packfile)
+                packsum = idx.buf[-40:-20]
+                order = idx.revindex()
+                offs = array("Q", [idx.offset(i) for i in order])
+            finally:
+                idx.close()
+            offs.append(packsize - 20)
+            tasks.append((verifytrailer, (idxfile,)))
+            tasks.append((verifytrailer, (packfile, packsum)))
+            for start in range(0, len(order), chunksize):
+                end = min(start + chunksize, len(order))
+                positions = array("I", order[start:end])
+                tasks.append((verifypackrange, (self.repo, packidx, positions, offs[start:end + 1], full)))
+                total += end - start
+
+        done = 0
+        if workers == 1:
+            results = (func(*args) for func, args in tasks)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = (future.result() for future in [executor.submit(func, *args) for func, args in tasks])
+        try:
+            for taskerrors, count in results:
+                errors += taskerrors
+                done += count
+                if progress:
+                    progress(done, total)
+        finally:
+            if workers != 1:
+                executor.shutdown()
+            else:
+                closeverifyrepos()
+
+        if full:
+            for objid in self.iterlooseobjs():
+                try:
+                    (ftype, raw) = self.readobjraw(objid)
+                except (zlib.error, ValueError, KeyError) as e:
+                    errors.append("%s: cannot read loose object: %s" % (objid.hex(), e))
+                    continue
+                if sha1(b"%s %d\x00" % (ftype.name.encode(), len(raw)) + raw).digest() != objid:
+                    errors.append("%s: sha1 mismatch for loose object" % objid.hex())
+        return errors
+
+    def itercommitraw(self):
+        for packidx in range(len(self.packnames)):
+            for objid, ftype, raw in self.scanpack(packidx, {GitObjectType.commit}):
+                if self.findobj(objid)[1] == packidx:
+                    yield (objid, raw)
+
+        for objid in self.iterlooseobjs():
+            if objid in self.objs or (self.midx and self.midx.find(objid)):
+                continue
+            fd = open(self.loosepath(objid), "rb")
             headerline = self.decompress(fd, 8)
             fd.close()
             if headerline.startswith(b"commit"):
-                yield self.readobj(objid)
+                yield (objid, self.readobjraw(objid)[1])
+
+    def itercommitobjs(self):
+        for objid, raw in self.itercommitraw():
+            yield GitCommitObject(objid, raw)
+
+verifyrepos = {}
+
+def closeverifyrepos():
+    while verifyrepos:
+        verifyrepos.popitem()[1].close()
+
+def verifypackrange(repopath, packidx, positions, offs, full):
+    errors = []
+    repo = verifyrepos.get(repopath)
+    if repo == None:
+        repo = verifyrepos[repopath] = GitRepo(repopath)
+    packfile = repo.packnames[packidx]
+    idx = GitPackIndex(packfile[:-5] + ".idx")
+    fd = open(packfile, "rb")
+    buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for n in range(len(positions)):
+            i = positions[n]
+            objid = idx.objid(i)
+            if zlib.crc32(buf[offs[n]:offs[n + 1]]) != idx.crc(i):
+                errors.append("%s: crc mismatch for %s at offset %d" % (packfile, objid.hex(), offs[n]))
+                continue
+            if full:
+                try:
+                    with repo.packfile(packidx) as packfd:
+                        (ftype, raw) = repo.readpackerobj(packfd, offs[n], packidx)
+                except (zlib.error, IndexError, ValueError) as e:
+                    errors.append("%s: cannot read %s at offset %d: %s" % (packfile, objid.hex(), offs[n], e))
+                    continue
+                if sha1(b"%s %d\x00" % (ftype.name.encode(), len(raw)) + raw).digest() != objid:
+                    errors.append("%s: sha1 mismatch for %s at offset %d" % (packfile, objid.hex(), offs[n]))
+    finally:
+        buf.close()
+        fd.close()
+        idx.close()
+    return (errors, len(positions))
+
+
+def verifytrailer(path, expected=None):
+    h = sha1()
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        remain = size - 20
+        while remain > 0:
+            buf = fd.read(min(remain, 1 << 20))
+            if buf == b'':
+                break
+            h.update(buf)
+            remain -= len(buf)
+        trailer = fd.read(20)
+    errors = []
+    if h.digest() != trailer:
+        errors.append("%s: trailer checksum mismatch" % path)
+    if expected != None and expected != trailer:
+        errors.append("%s: checksum does not match its idx" % path)
+    return (errors, 0)
+
+
+class RepoPoolEntry:
+    def __init__(self, repo):
+        self.repo = repo
+        self.users = 0
+        self.lastuse = time.time()
+        self.score = 0.0
+
+    def touch(self, now, halflife):
+        self.score = self.score * 0.5 ** ((now - self.lastuse) / halflife) + 1
+        self.lastuse = now
+
+
+class RepoPool:
+    def __init__(self, maxbytes=1 << 30, maxopenpacks=512, maxrepos=None, idletimeout=600, halflife=300):
+        self.maxbytes = maxbytes
+        self.maxrepos = maxrepos
+        self.idletimeout = idletimeout
+        self.halflife = halflife
+        self.packcache = PackFileCache(maxopenpacks)
+        self.entries = {}
+        self.uses = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def repo(self, path):
+        entry = self.acquire(path)
+        try:
+            yield entry.repo
+        finally:
+            self.release(entry)
+
+    def acquire(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry != None:
+                return self.use(entry)
+        repo = GitRepo(path, self.packcache, 0, 0)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry == None:
+                entry = self.entries[path] = RepoPoolEntry(repo)
+                self.uses = 0
+                repo = None
+            entry = self.use(entry)
+        if repo != None:
+            repo.close()
+        return entry
+
+    def use(self, entry):
+        now = time.time()
+        entry.users += 1
+        entry.touch(now, self.halflife)
+        if self.uses % 64 == 0:
+            self.evict(now)
+            self.rebalance(now)
+        self.uses += 1
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.users -= 1
+            entry.lastuse = time.time()
+
+    def evict(self, now):
+        idle = [(e.lastuse, path) for path, e in self.entries.items() if e.users == 0]
+        idle.sort()
+        excess = len(self.entries) - self.maxrepos if self.maxrepos != None else 0
+        for lastuse, path in idle:
+            if excess <= 0 and now - lastuse < self.idletimeout:
+                break
+            self.entries.pop(path).repo.close()
+            excess -= 1
+
+    def rebalance(self, now):
+        scores = {}
+        for path, e in self.entries.items():
+            scores[path] = e.score * 0.5 ** ((now - e.lastuse) / self.halflife)
+        total = sum(scores.values())
+        for path, e in self.entries.items():
+            share = self.maxbytes * scores[path] / total if total else self.maxbytes / len(self.entries)
+            e.repo.objcache.resize(int(share * 2 / 3))
+            e.repo.deltacache.resize(int(share / 3))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "repos": len(self.entries),
+                "openpacks": self.packcache.opened,
+                "cachebytes": sum(e.repo.objcache.bytes + e.repo.deltacache.bytes for e in self.entries.values()),
+                "budgets": {path: e.repo.objcache.maxbytes + e.repo.deltacache.maxbytes for path, e in self.entries.items()},
+            }
+
+    def close(self):
+        with self.lock:
+            for e in self.entries.values():
+                e.repo.close()
+            self.entries.clear()
+
+
+def catfile(repo, args):
+    if args.batch_all_objects:
+        if args.unordered:
+            packed = sorted(((idx, off), objid) for objid, (off, idx) in repo.iterpackobjs())
+            objids = [objid for loc, objid in packed]
+            known = set(objids)
+            objids += [objid for objid in repo.iterlooseobjs() if objid not in known]
+        else:
+            objids = sorted(set([objid for objid, loc in repo.iterpackobjs()] + list(repo.iterlooseobjs())))
+        requests = [(objid.hex(), objid) for objid in objids]
+    else:
+        requests = ((line.rstrip("\r\n"), None) for line in sys.stdin)
+        if args.unordered:
+            requests = [(name, repo.resolveobj(name)) for name, objid in requests]
+            packed = []
+            for name, objid in requests:
+                loc = repo.findobj(objid) if objid else None
+                if loc and loc[1] >= 0:
+                    packed.append(((loc[1], loc[0]), name, objid))
+                else:
+                    packed.append(((len(repo.packnames), 0), name, objid))
+            packed.sort(key=lambda x: x[0])
+            requests = [(name, objid) for loc, name, objid in packed]
+
+    out = open(sys.stdout.fileno(), "wb", buffering=1 << 20, closefd=False)
+    for name, objid in requests:
+        if objid == None and name:
+            objid = repo.resolveobj(name)
+        if args.batch:
+            (ftype, raw) = repo.readobjraw(objid) if objid else (None, None)
+            if ftype == None:
+                out.write(name.encode() + b" missing\n")
+            else:
+                out.write(("%s %s %d\n" % (objid.hex(), ftype.name, len(raw))).encode())
+                out.write(raw)
+                out.write(b"\n")
+        else:
+            (ftype, flen) = repo.readobjheader(objid) if objid else (None, None)
+            if ftype == None:
+                out.write(name.encode() + b" missing\n")
+            else:
+                out.write(("%s %s %d\n" % (objid.hex(), ftype.name, flen)).encode())
+        if not args.buffer:
+            out.flush()
+    out.flush()
+
 
 if __name__ == "__main__":
-    git = GitRepo("D:\\github\\Mindustry\\.git")
-    git.readobj(bytes.fromhex("d65f226b3ae5eebe7439f83c7d213284d6159cfe"))
-    commits = list(git.itercommitobjs())
-    print(len(commits))
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m gittool")
+    parser.add_argument("--git-dir", default=os.environ.get("GIT_DIR"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    catfileparser = commands.add_parser("cat-file", help="git cat-file --batch/--batch-check compatible object reader")
+    mode = catfileparser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--batch", action="store_true")
+    mode.add_argument("--batch-check", action="store_true")
+    catfileparser.add_argument("--batch-all-objects", action="store_true")
+    catfileparser.add_argument("--buffer", action="store_true", help="do not flush after every object")
+    catfileparser.add_argument("--unordered", action="store_true", help="answer in pack offset order instead of input order")
+    exportparser = commands.add_parser("export", help="write a snapshot of a commit to a directory or tar file")
+    exportparser.add_argument("commit")
+    exportparser.add_argument("dest", help="directory, or a .tar/.tar.gz/.tgz file, or - for a tar on stdout")
+    exportparser.add_argument("pathspec", nargs="*")
+    exportparser.add_argument("--threads", type=int, default=8)
+    verifyparser = commands.add_parser("verify", help="check pack and idx checksums and per-object crc32")
+    verifyparser.add_argument("--full", action="store_true", help="also reconstruct every object and check its sha1")
+    verifyparser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    gitdir = args.git_dir
+    if gitdir == None:
+        gitdir = ".git" if os.path.isdir(".git") else "."
+    repo = GitRepo(gitdir)
+    if args.command == "cat-file":
+        try:
+            catfile(repo, args)
+        except BrokenPipeError:
+            pass
+    elif args.command == "export":
+        pathspec = args.pathspec if args.pathspec else None
+        try:
+            if args.dest == "-":
+                with tarfile.open(fileobj=sys.stdout.buffer, mode="w|") as tar:
+                    repo.export(args.commit, tar, pathspec, args.threads)
+            elif args.dest.endswith((".tar", ".tar.gz", ".tgz")):
+                with tarfile.open(args.dest, "w|gz" if args.dest.endswith("gz") else "w|") as tar:
+                    repo.export(args.commit, tar, pathspec, args.threads)
+            else:
+                repo.export(args.commit, args.dest, pathspec, args.threads)
+        except GitError as e:
+            sys.exit(str(e))
+    elif args.command == "verify":
+        def showprogress(done, total):
+            sys.stderr.write("\rVerifying objects: %d/%d" % (done, total))
+        errors = repo.verify(args.full, args.workers, progress=showprogress)
+        sys.stderr.write("\n")
+        for error in errors:
+            print(error)
+        sys.exit(1 if errors else 0)